@@ -1,128 +1,156 @@
+'''
+AFCluster: MSA search, clustering and structure prediction per target.
+
+    python afcluster.py --input targets.fasta            # everything (same as: run)
+    python afcluster.py msa --input targets.fasta        # one stage: msa, cluster or predict (+ harvest)
+    python afcluster.py status --input targets.fasta     # what is left per target, from the output folders
+    python afcluster.py plan --input targets.fasta       # estimated time and memory of the remaining work
+
+Each subcommand imports only the stages it runs, so status and plan answer
+without loading the clustering or search stacks.
+'''
 import os
 import sys
-import glob
-import copy
 import yaml
 import argparse
-import subprocess
-import numpy as np
-import pandas as pd
-
-from src.cluster import *
-from src.utils.msa import *
-from src.utils.seqs import *
-from src.utils.mmseqs import *
+
 from src.utils.helpers import *
 
-def get_labels(args, df):
-    if args.cluster_method == "dbscan":
-        return cluster_DBSCAN(args, df)
-    raise ValueError(f"Unknown clustering method")
-
-
-def generate_command(args, return_seeds=False):
-    run_command = ['colabfold_batch']
-    afcluster = dict_to_namespace(args.afcluster)
-    if return_seeds:
-        return afcluster.num_seeds
-    if afcluster.amber:
-        run_commmand.extend(['--amber'])
-        if torch.cuda.is_available():
-            run_command.extend(['--use-gpu-relax'])
-        run_command.extend(['--num-relax', f'{afcluster.num_relax}'])
-    if afcluster.use_dropout:
-        run_command.extend(['--use-dropout'])
-    run_command.extend(['--num-recycle', f'{afcluster.num_recycle}'])
-    if afcluster.templates:
-        run_command.extend(['--templates'])
-    return run_command
-
-
-def run_cluster(args, subfolder, input):
-
-    with open(f"{subfolder}/{args.keyword}.log", "w") as f:
-        IDs, seqs_incl_del = load_fasta(input)
-        seqs = clean_seqs(seqs_incl_del)
-
-        df = pd.DataFrame({'SequenceName': IDs, 'sequence': seqs, 'seq_incl_del': seqs_incl_del})
-        query_ = df.iloc[:1]
-        df = df.iloc[1:]
-        L = len(df.sequence.iloc[0])
-        df['frac_gaps'] = [x.count('-') / L for x in df['sequence']]
-
-        df = df.loc[df.frac_gaps < float(args.gap_cutoff)]
-        f.write(f"Filtered sequences by gap_cutoff={args.gap_cutoff}\n")
-        
-        df, clusters = get_labels(args, df)
-
-        f.write(f"Found {len(clusters)} clusters using {args.cluster_method}\n")
-
-        cluster_dir = os.path.join(subfolder, "clusters",)
-        os.makedirs(cluster_dir, exist_ok=True)
-        for clust in clusters:
-            tmp = df.loc[df.dbscan_label == clust]
-            out = pd.concat([query_, tmp], axis=0)
-            outpath = os.path.join(cluster_dir, f"{args.keyword}_{clust:03d}.a3m")
-            write_fasta(out.SequenceName.tolist(), out.seq_incl_del.tolist(), outfile=outpath)
-            f.write(f"Wrote {outpath} (n={len(out)})\n")
-    os.remove(f"{subfolder}/{args.keyword}.log")
+COMMANDS = ['run', 'msa', 'cluster', 'predict', 'plan', 'status']
 
-def main(args):
+def load_targets(args):
+    ''' ids and seqs from --input or --seq; without either, status lists the target folders in outdir '''
     if args.input is not None:
-        ids, seqs = load_fasta(args.input);
+        from src.utils.msa import load_fasta
+        return load_fasta(args.input)
     if args.seq is not None:
-        seqs = [args.seq]
-        ids = [args.jobid]
-    if args.msa is not None and len(ids) > 0:
-        print(f'Assuming ID associated with input MSA is {id[0]}.')
-        subfolder = os.path.join(args.outdir, ids[0])
-        
+        return [args.jobid], [args.seq]
+    if args.command == 'status' and os.path.isdir(args.outdir):
+        ids = sorted(d for d in os.listdir(args.outdir)
+                     if not d.startswith(('.', '_')) and os.path.isdir(os.path.join(args.outdir, d)))
+        return ids, [None] * len(ids)
+    return [args.jobid], [None]
+
+def cluster_input_msa(args, ids):
+    ''' Cluster --msa as the first target '''
+    from src.cluster import run_cluster
+    print(f'Assuming ID associated with input MSA is {ids[0]}.')
+    args.keyword = ids[0]
+    subfolder = os.path.join(args.outdir, ids[0])
+    os.makedirs(subfolder, exist_ok=True)
+    print(f'Running clustering...')
+    run_cluster(args, subfolder, args.msa)
+
+def harvest_enabled(args):
+    return getattr(args, 'harvest', None) is not None and dict_to_namespace(args.harvest).enabled
+
+def run_msa(args, ids, seqs):
+    from src.search import generate_msas
+    print(f'Running generating MSA...')
+    generate_msas(args, ids, seqs)
+
+def run_clusters(args, ids, seqs):
+    from src.cluster import run_cluster
+    if args.msa is not None:
+        return cluster_input_msa(args, ids)
+    for id_ in ids:
+        args.keyword = id_
+        subfolder = os.path.join(args.outdir, id_)
         print(f'Running clustering...')
-        run_cluster(args, subfolder, args.msa)
+        run_cluster(args, subfolder, os.path.join(subfolder, f'{id_}.a3m'))
+
+def run_predict(args, ids, seqs):
+    from src.predict import run_predictions
+    from src.harvest import run_harvest
+    for id_ in ids:
+        args.keyword = id_
+        subfolder = os.path.join(args.outdir, id_)
+        print(f'Running structure prediction...')
+        run_predictions(args, subfolder)
+
+        if harvest_enabled(args):
+            print(f'Collecting prediction scores...')
+            run_harvest(args, subfolder)
+
+def run_all(args, ids, seqs):
+    if args.msa is not None:
+        cluster_input_msa(args, ids)
+        if seqs[0] is None:
+            return
+
+    if getattr(args, 'pipeline', None) is not None and dict_to_namespace(args.pipeline).enabled:
+        from src.pipeline import run_pipeline
+        print(f'Running pipelined MSA generation, clustering and structure prediction...')
+        run_pipeline(args, ids, seqs)
+        return
+
+    from src.cluster import run_cluster
+    from src.predict import run_predictions
+    from src.harvest import run_harvest
+    run_msa(args, ids, seqs)
 
     for id_, seq_ in zip(ids, seqs): 
         args.keyword = id_
         subfolder = os.path.join(args.outdir, id_)
         os.makedirs(subfolder, exist_ok=True)
         msa_file = os.path.join(subfolder, f'{id_}.a3m')
-        
-        print(f'Running generating MSA...')
-        if not os.path.exists(msa_file): 
-            msa_seqs = run_mmseqs(seq_, args.tmpdir)
-            with open(msa_file, "w") as a3m:
-                a3m.write(msa_seqs[0])
-        
+
         print(f'Running clustering...')
         run_cluster(args, subfolder, msa_file)
 
         print(f'Running structure prediction...')
-        pred_dir = os.path.join(subfolder, 'preds')
-        os.makedirs(pred_dir, exist_ok=True)
-        seeds = generate_command(args, return_seeds=True)
-        for i in np.arange(0, seeds):
-            for fil in glob.glob(f"{subfolder}/clusters/*.a3m"):
-                fil_name = os.path.splitext(os.path.basename(fil))[0]                
-                os.makedirs(f'{pred_dir}/{fil_name}/s{i}', exist_ok=True)
-                if os.path.exists(f'{pred_dir}/{fil_name}/s{i}/{fil_name}_0.done.txt'):
-                    continue
-
-                run_command = generate_command(args)
-                run_command.extend(['--random-seed', f'{i}'])
-                run_command.extend(['--jobname-prefix', f'{fil_name}'])
-                run_command.extend([f'{fil}', f'{pred_dir}/{fil_name}/s{i}'])
-                subprocess.run(run_command, shell=False)
-
-if __name__ == "__main__":
-    p = argparse.ArgumentParser()
+        run_predictions(args, subfolder)
+
+        if harvest_enabled(args):
+            print(f'Collecting prediction scores...')
+            run_harvest(args, subfolder)
+
+def show_status(args, ids, seqs):
+    from src.status import target_status, format_status
+    print(format_status([target_status(args, id_, seq_) for id_, seq_ in zip(ids, seqs)]))
+
+def show_plan(args, ids, seqs):
+    from src.plan import plan_jobs
+    if any(seq_ is None for seq_ in seqs):
+        exit('plan needs target sequences (--input or --seq)')
+    plan = plan_jobs(args, ids, seqs)
+    print(f"{'target':<24} {'length':>6} {'depth':>14} {'clusters':>8} {'structures':>10} {'est_h':>7} {'mem_gb':>6}")
+    for t in plan['targets']:
+        depth = f"{t['depth']} ({t['depth_source']})"
+        print(f"{t['id']:<24} {t['length']:>6} {depth:>14} {t['n_clusters']:>8} {t['n_structures']:>10} "
+              f"{t['est_s'] / 3600:>7.2f} {t['mem_gb']:>6.1f}")
+    print(f"{plan['n_targets'] - plan['n_done']} of {plan['n_targets']} targets with work left, "
+          f"~{plan['est_total_h']:.1f} GPU-hours (with slurm.safety)")
+
+RUNNERS = {'run': run_all, 'msa': run_msa, 'cluster': run_clusters, 'predict': run_predict,
+           'plan': show_plan, 'status': show_status}
 
-    p.add_argument("--input", type=str, default=None, help="Input fasta")
-    p.add_argument('--msa', type=str, default=None, help='Initial input MSA')
-    p.add_argument('--seq', type=str, default=None, help='Initial input sequence')
-    p.add_argument('--config', type=str, default='configs/afcluster.yml', help='Initial config')
-    p.add_argument('--jobid', type=str, default='default')
-    args = p.parse_args()
+def main(args):
+    ids, seqs = load_targets(args)
+    RUNNERS[args.command](args, ids, seqs)
 
-    if args.input is None and args.msa is None and args.seq is None:
+if __name__ == "__main__":
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--input", type=str, default=None, help="Input fasta")
+    common.add_argument('--msa', type=str, default=None, help='Initial input MSA')
+    common.add_argument('--seq', type=str, default=None, help='Initial input sequence')
+    common.add_argument('--config', type=str, default='configs/afcluster.yml', help='Initial config')
+    common.add_argument('--jobid', type=str, default='default')
+
+    p = argparse.ArgumentParser(description='Without a subcommand, runs every stage (run).')
+    sub = p.add_subparsers(dest='command')
+    sub.add_parser('run', parents=[common], help='MSA search, clustering, prediction and harvest')
+    sub.add_parser('msa', parents=[common], help='MSA search only')
+    sub.add_parser('cluster', parents=[common], help='Cluster existing MSAs (or --msa)')
+    sub.add_parser('predict', parents=[common], help='Predict existing clusters, then harvest')
+    sub.add_parser('plan', parents=[common], help='Estimated time and memory of the remaining work per target')
+    sub.add_parser('status', parents=[common], help='Remaining work per target, from the output folders')
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['run'] + argv
+    args = p.parse_args(argv)
+
+    if args.input is None and args.msa is None and args.seq is None and args.command != 'status':
         exit('Must specify either input or MSA or sequence')
     
     with open(args.config, "r") as f:
@@ -131,11 +159,13 @@ if __name__ == "__main__":
     for k, v in cfg.items():
         setattr(args, k, v)
 
+    if args.command in ('plan', 'status'):
+        main(args)
+        exit()
+
     os.makedirs(args.outdir, exist_ok=True)
     os.makedirs(args.tmpdir, exist_ok=True)
 
-    np.random.default_rng(seed=args.random_seed)
-    
     os.environ['PATH'] = args.path_vars['PATH']
     os.environ["XDG_CACHE_HOME"] = args.path_vars['XDG_CACHE_HOME']
     os.environ["MPLCONFIGDIR"] = args.path_vars['MPLCONFIGDIR']
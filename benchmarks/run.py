@@ -0,0 +1,167 @@
+'''
+Clustering throughput, peak memory and cluster recovery on synthetic MSAs.
+
+Every size point is written by benchmarks.synthetic and clustered through
+the real run_cluster path (parse -> filter -> encode -> eps selection -> fit
+-> write) in a fresh process, so peak RSS is per point. Stage times come from
+the run report (see src/utils/instrument.py). Recovery is the ARI between the
+written clusters and the planted families over the rows placed in a cluster,
+plus the fraction of rows placed (coverage; DBSCAN leaves the rest as noise).
+Results are compared with a stored baseline: lower ARI or coverage, or
+time/memory above the allowed factors, is reported as a regression and
+exits non-zero. Timings are machine specific, so re-record the baseline
+(--update-baseline) on the machine you compare on.
+
+    python -m benchmarks.run                                # quick suite vs benchmarks/baseline.json
+    python -m benchmarks.run --suite full --update-baseline
+    python -m benchmarks.run --points 20000x300 50000x300 --method reachability
+'''
+import os
+import sys
+import json
+import shutil
+import glob
+import yaml
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.metrics import adjusted_rand_score
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import write_synthetic_a3m
+from src.utils.a3m import map_file, index_records
+
+SUITES = {
+    'quick': [(1000, 100), (5000, 200), (10000, 250)],
+    'full': [(1000, 100), (5000, 200), (20000, 300), (100000, 300), (200000, 500), (500000, 1500)],
+}
+STAGES = ['parse_encode', 'gap_filter', 'dedup', 'eps_estimate', 'dbscan_fit', 'reachability_fit', 'lsh_graph',
+          'cluster', 'write_clusters']
+
+def point_name(N, L, opts):
+    return f'N{N}_L{L}_g{opts.gap_rate}_i{opts.ins_rate}_f{opts.families}_{opts.method}'
+
+def bench_args(opts, workdir):
+    ''' Pipeline config for benchmarking: opts.config with caching off and instrumentation on '''
+    with open(opts.config) as f:
+        cfg = yaml.safe_load(f)
+    args = argparse.Namespace(**cfg)
+    args.keyword = 'BENCH'
+    args.outdir = args.tmpdir = workdir
+    args.cluster_method = opts.method
+    args.cache = dict(enabled=False)
+    args.instrument = dict(enabled=True, profile=False, tracemalloc=False)
+    return args
+
+def cluster_labels(cluster_dir, N):
+    ''' Cluster index of every synthetic row (-1 if in no cluster) from the headers of the written a3ms '''
+    labels = np.full(N, -1, dtype=np.int64)
+    for k, path in enumerate(sorted(glob.glob(os.path.join(cluster_dir, '*.a3m')))):
+        buf = map_file(path)
+        header_starts, id_ends, _, _ = index_records(buf)
+        raw = buf.tobytes()
+        rows = [int(raw[h + 2:e].split(b'_f')[0]) for h, e in zip(header_starts[1:], id_ends[1:])]  # skip the query
+        labels[rows] = k
+    return labels
+
+def run_point(args, a3m_path, truth_path, subfolder):
+    ''' Cluster one synthetic MSA and summarise its run report (runs in a fresh process) '''
+    from src.cluster import run_cluster
+    # start from an empty folder: a manifest or clusters from an earlier run would make run_cluster skip
+    shutil.rmtree(subfolder, ignore_errors=True)
+    os.makedirs(subfolder)
+    report = os.path.join(subfolder, 'run_report.jsonl')
+    run_cluster(args, subfolder, a3m_path)
+
+    with open(report) as f:
+        records = [json.loads(line) for line in f]
+    total = next(r for r in records if r['stage'] == 'run_cluster')
+    truth = np.load(truth_path)
+    pred = cluster_labels(os.path.join(subfolder, 'clusters'), len(truth))
+    return {'n_rows': int(len(truth)),
+            'wall_s': total['wall_s'],
+            'cpu_s': total['cpu_s'],
+            'rows_per_s': len(truth) / total['wall_s'],
+            'peak_rss_mb': total['peak_rss_mb'],
+            'ari': float(adjusted_rand_score(truth[pred >= 0], pred[pred >= 0])) if (pred >= 0).any() else 0.0,
+            'coverage': float((pred >= 0).mean()),
+            'n_clusters': int(pred.max() + 1),
+            'n_planted': int(truth.max() + 1),
+            'stages': {r['stage']: r['wall_s'] for r in records if r['stage'] in STAGES}}
+
+def regressions(name, result, base, opts):
+    found = []
+    if result['ari'] < base['ari'] - opts.ari_tol:
+        found.append(f"{name}: ARI {result['ari']:.3f} < baseline {base['ari']:.3f}")
+    if result['coverage'] < base['coverage'] - opts.ari_tol:
+        found.append(f"{name}: coverage {result['coverage']:.3f} < baseline {base['coverage']:.3f}")
+    if result['wall_s'] > base['wall_s'] * opts.max_slowdown:
+        found.append(f"{name}: {result['wall_s']:.2f}s > {opts.max_slowdown}x baseline {base['wall_s']:.2f}s")
+    if result['peak_rss_mb'] > base['peak_rss_mb'] * opts.max_memory:
+        found.append(f"{name}: {result['peak_rss_mb']:.0f} MB > {opts.max_memory}x baseline {base['peak_rss_mb']:.0f} MB")
+    return found
+
+def main(opts):
+    points = [tuple(int(x) for x in p.split('x')) for p in opts.points] if opts.points else SUITES[opts.suite]
+    os.makedirs(opts.workdir, exist_ok=True)
+    args = bench_args(opts, opts.workdir)
+    results = {}
+    for N, L in points:
+        name = point_name(N, L, opts)
+        a3m_path = os.path.join(opts.workdir, f'{name}_s{opts.seed}.a3m')
+        truth_path = f'{a3m_path}.labels.npy'
+        if not os.path.exists(truth_path):
+            labels = write_synthetic_a3m(a3m_path, N=N, L=L, n_families=opts.families, gap_rate=opts.gap_rate,
+                                         ins_rate=opts.ins_rate, seed=opts.seed)
+            np.save(truth_path, labels)
+        # a fresh process per point keeps peak RSS from leaking across points
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results[name] = pool.submit(run_point, args, a3m_path, truth_path, os.path.join(opts.workdir, name)).result()
+        r = results[name]
+        print(f"{name}: {r['wall_s']:.2f}s ({r['rows_per_s']:.0f} rows/s), peak {r['peak_rss_mb']:.0f} MB, "
+              f"ARI {r['ari']:.3f} on {r['coverage']:.0%} clustered, {r['n_clusters']}/{r['n_planted']} clusters")
+        print('    ' + ', '.join(f'{k} {v:.2f}s' for k, v in r['stages'].items()))
+
+    if opts.out:
+        with open(opts.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    baseline = {}
+    if os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+    if opts.update_baseline:
+        baseline.update(results)
+        with open(opts.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'Updated {opts.baseline}')
+        return 0
+
+    found = [msg for name, r in results.items() if name in baseline for msg in regressions(name, r, baseline[name], opts)]
+    missing = [name for name in results if name not in baseline]
+    if missing:
+        print(f"No baseline for {', '.join(missing)}")
+    for msg in found:
+        print(f'REGRESSION {msg}')
+    return 1 if found else 0
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('--suite', choices=sorted(SUITES), default='quick')
+    p.add_argument('--points', nargs='*', default=None, help='NxL size points, overriding --suite')
+    p.add_argument('--families', type=int, default=5, help='Planted sub-families')
+    p.add_argument('--gap-rate', type=float, default=0.05)
+    p.add_argument('--ins-rate', type=float, default=0.02)
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--method', type=str, default='dbscan', help='cluster_method to benchmark')
+    p.add_argument('--config', type=str, default=os.path.join(ROOT, 'configs', 'afcluster.yml'))
+    p.add_argument('--workdir', type=str, default='/tmp/afcluster_bench')
+    p.add_argument('--baseline', type=str, default=os.path.join(ROOT, 'benchmarks', 'baseline.json'))
+    p.add_argument('--update-baseline', action='store_true')
+    p.add_argument('--out', type=str, default=None, help='Also write this run\'s results as JSON')
+    p.add_argument('--ari-tol', type=float, default=0.02, help='Allowed drop in ARI and coverage')
+    p.add_argument('--max-slowdown', type=float, default=1.5)
+    p.add_argument('--max-memory', type=float, default=1.5)
+    sys.exit(main(p.parse_args()))
@@ -1,22 +1,47 @@
-import os
-import shutil
-import zipfile
-
-base_dir = "/scratch/users/gelnesr/afcluster"
-os.chdir(base_dir)
-
-# Step 1: zip each inner folder
-for folder in os.listdir(base_dir):
-    folder_path = os.path.join(base_dir, folder)
-    if os.path.isdir(folder_path):
-        zip_path = f"{folder}.zip"
-        print(f"Zipping {folder_path} → {zip_path}")
-        shutil.make_archive(folder, 'zip', folder_path)
-
-# Step 2: zip all the generated zip files into one big zip
-final_zip = "28oct25_afcluster_ge.zip"
-with zipfile.ZipFile(final_zip, 'w', zipfile.ZIP_DEFLATED) as zf:
-    for z in os.listdir(base_dir):
-        if z.endswith(".zip") and z != final_zip:
-            zf.write(z)
-print(f"Created {final_zip}")
\ No newline at end of file
+'''
+Archive afcluster results for transfer.
+
+Every target folder in outdir is compressed on its own worker process into
+{dest}/{target}.zip; dest/index.json records what went into each archive, so
+reruns only re-archive new or changed targets. Filters and defaults live
+under archive: in the config; the options below override them.
+
+    python filehandling.py                                   # outdir and archive settings from the config
+    python filehandling.py --exclude 'clusters/*' --max-rank 1 --bundle
+'''
+import yaml
+import argparse
+
+from src.archive import *
+
+def main(args):
+    archive = dict(getattr(args, 'archive', None) or {})
+    for key in ['dest', 'workers', 'include', 'exclude', 'max_rank', 'bundle', 'name']:
+        if getattr(args, f'cli_{key}') is not None:
+            archive[key] = getattr(args, f'cli_{key}')
+    args.archive = archive
+    run_archive(args)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('--config', type=str, default='configs/afcluster.yml')
+    p.add_argument('--outdir', type=str, default=None, help='Results to archive (default: outdir from the config)')
+    p.add_argument('--dest', dest='cli_dest', type=str, default=None, help='Archive directory (default: {outdir}_archive)')
+    p.add_argument('--workers', dest='cli_workers', type=int, default=None, help='Compression processes (default: all cores)')
+    p.add_argument('--include', dest='cli_include', type=str, nargs='+', default=None, help='Globs of paths to keep, relative to each target folder')
+    p.add_argument('--exclude', dest='cli_exclude', type=str, nargs='+', default=None, help="Globs of paths to leave out, e.g. 'clusters/*'")
+    p.add_argument('--max-rank', dest='cli_max_rank', type=int, default=None, help='Keep only models ranked at most this')
+    p.add_argument('--bundle', dest='cli_bundle', action='store_true', default=None, help='Also store all target archives in one {dest}/{name}.zip')
+    p.add_argument('--name', dest='cli_name', type=str, default=None, help='Bundle name (default: name of outdir)')
+    args = p.parse_args()
+
+    with open(args.config, "r") as f:
+        cfg = yaml.safe_load(f)
+
+    outdir = args.outdir
+    for k, v in cfg.items():
+        setattr(args, k, v)
+    if outdir is not None:
+        args.outdir = outdir
+
+    main(args)
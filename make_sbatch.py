@@ -1,26 +1,76 @@
+'''
+Plan and submit afcluster runs as Slurm job arrays.
+
+Every target (FASTA record) gets an estimated cost from its length, MSA depth
+(counted from an existing a3m, estimated from the MSA store, or assumed),
+expected cluster count and num_seeds, minus any clustering or predictions
+already on disk. Targets are packed into shards of balanced estimated
+runtime; each shard is one array task running afcluster.py on a shard FASTA,
+and shards with the same memory/time request share one array. Cost model and
+Slurm settings live under slurm: in the config.
+
+    python make_sbatch.py --input '/path/to/fasta/*.fasta' --dry-run   # write plan.json and scripts only
+    python make_sbatch.py --input targets.fasta --n-shards 20
+'''
 import os
 import glob
+import yaml
+import argparse
 import subprocess
-seed = 8
-
-for file_ in glob.glob('/scratch/users/gelnesr/RelaxDB/fasta/*.fasta'):
-    file_name = file_.split('/')[-1].strip('.fasta')
-    subprocess.run(['rm', f'/scratch/users/gelnesr/tmp/afc/sbatch/{file_name}.sbatch'])
-
-    file_new = open(f'/scratch/users/gelnesr/tmp/afc/sbatch/{file_name}.sbatch', 'x')
-    file_new.write('#!/bin/bash\n')
-    file_new.write(f'#SBATCH --time=2-00:00:00\n')
-    file_new.write(f'#SBATCH -p possu,bioe,owners\n')
-    file_new.write(f'#SBATCH --gres=gpu:1\n')
-    file_new.write(f'#SBATCH --mem=40G\n')
-    file_new.write(f'#SBATCH -c 8\n')
-    file_new.write(f'#SBATCH --job-name={file_name}\n')
-    file_new.write(f'#SBATCH --output=/scratch/users/gelnesr/tmp/afc/out/{file_name}.out\n')
-    file_new.write(f'#SBATCH --error=/scratch/users/gelnesr/tmp/afc/err/{file_name}.err\n')
-    file_new.write(f'#SBATCH --gpu_cmode=shared\n') 
-    file_new.write(f'ml gcc/12.4.0\n')
-    file_new.write(f'bash scripts/setup_slurm.sh\n')
-    file_new.write(f'python afcluster.py --input {file_}')
-    file_new.close()
-    subprocess.run(["sbatch", f'/scratch/users/gelnesr/tmp/afc/sbatch/{file_name}.sbatch'])
 
+from src.plan import *
+from src.utils.msa import *
+from src.utils.helpers import *
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def load_targets(patterns):
+    ''' ids and seqs of every record in the FASTAs matching patterns; repeated ids keep their first sequence '''
+    ids, seqs = [], []
+    for pattern in patterns:
+        for fil in sorted(glob.glob(pattern)):
+            for id_, seq_ in zip(*load_fasta(fil)):
+                if id_ in ids:
+                    print(f'Skipping repeated target {id_} in {fil}')
+                    continue
+                ids.append(id_)
+                seqs.append(seq_)
+    return ids, seqs
+
+def main(args):
+    ids, seqs = load_targets(args.input)
+    if not ids:
+        exit(f'No targets found in {args.input}')
+    script_dir = args.script_dir or os.path.join(args.tmpdir, 'sbatch')
+
+    plan = plan_jobs(args, ids, seqs, n_shards=args.n_shards)
+    print(f"{plan['n_targets']} targets ({plan['n_done']} already done), "
+          f"~{plan['est_total_h']:.1f} GPU-hours in {len(plan['shards'])} shards")
+    if not plan['shards']:
+        return
+    scripts = write_plan(args, plan, ids, seqs, script_dir, os.path.abspath(args.config), ROOT)
+    for array in plan['arrays']:
+        print(f"  {array['name']}: {array['n_tasks']} tasks, {array['mem_gb']}G, {array['hours']}h -> {array['script']}")
+
+    if args.dry_run:
+        print(f"Dry run: plan written to {os.path.join(script_dir, 'plan.json')}")
+        return
+    for script in scripts:
+        subprocess.run(['sbatch', script], check=True)
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument('--input', type=str, nargs='+', required=True, help='FASTA files or glob patterns')
+    p.add_argument('--config', type=str, default='configs/afcluster.yml', help='Config passed to every shard')
+    p.add_argument('--n-shards', type=int, default=None, help='Number of array tasks (default: from slurm.shard_hours)')
+    p.add_argument('--script-dir', type=str, default=None, help='Where shards, scripts and plan.json go (default: {tmpdir}/sbatch)')
+    p.add_argument('--dry-run', action='store_true', help='Write the plan and scripts without calling sbatch')
+    args = p.parse_args()
+
+    with open(args.config, "r") as f:
+        cfg = yaml.safe_load(f)
+
+    for k, v in cfg.items():
+        setattr(args, k, v)
+
+    main(args)
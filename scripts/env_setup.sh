@@ -21,4 +21,4 @@ else
 fi
 
 source afc/bin/activate
-uv pip install numpy pandas biopython scikit-learn tqdm requests pyyaml
+uv pip install numpy scikit-learn tqdm requests pyyaml
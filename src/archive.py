@@ -0,0 +1,134 @@
+import os
+import re
+import json
+import fnmatch
+import hashlib
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.utils.helpers import *
+
+# Already compressed; stored as-is instead of deflated again
+STORED = ('.zip', '.gz', '.bz2', '.xz', '.png', '.jpg', '.jpeg')
+_RANK = re.compile(r'_rank_(\d+)_')
+
+def archive_config(args):
+    ''' The archive: block of the config with defaults filled in '''
+    archive = {'dest': None, 'workers': None, 'include': ['*'], 'exclude': [], 'max_rank': None,
+               'level': 6, 'bundle': False, 'name': None, **(getattr(args, 'archive', None) or {})}
+    archive['dest'] = archive['dest'] or f"{os.path.normpath(args.outdir)}_archive"
+    archive['name'] = archive['name'] or os.path.basename(os.path.normpath(args.outdir))
+    return dict_to_namespace(archive)
+
+def selected(rel, include, exclude, max_rank=None):
+    ''' True if the path (relative to its target folder) passes the include/exclude globs and the rank cut '''
+    if not any(fnmatch.fnmatch(rel, p) for p in include) or any(fnmatch.fnmatch(rel, p) for p in exclude):
+        return False
+    rank = _RANK.search(os.path.basename(rel))
+    return max_rank is None or rank is None or int(rank.group(1)) <= max_rank
+
+def target_files(folder, include, exclude, max_rank=None):
+    ''' Sorted [(relative path, size, mtime_ns)] of the regular files in folder that pass the filters; symlinks and *.part files are left out '''
+    files = []
+    for root, dirs, names in os.walk(folder):
+        dirs.sort()
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, folder)
+            if name.endswith('.part') or os.path.islink(path) or not selected(rel, include, exclude, max_rank):
+                continue
+            st = os.stat(path)
+            files.append((rel, st.st_size, st.st_mtime_ns))
+    return sorted(files)
+
+def signature(files, filters):
+    ''' Hash over the file list (names, sizes, mtimes) and the filters; changes whenever the target's archive would '''
+    return hashlib.sha1(json.dumps({'files': files, 'filters': filters}).encode()).hexdigest()
+
+def archive_target(folder, dest, files, level=6):
+    ''' Stream the given files of folder into dest (a zip under the target's name), deflating all but already compressed files '''
+    target = os.path.basename(os.path.normpath(folder))
+    with zipfile.ZipFile(f'{dest}.part', 'w', zipfile.ZIP_DEFLATED, compresslevel=level, allowZip64=True) as zf:
+        for rel, _, _ in files:
+            zf.write(os.path.join(folder, rel), os.path.join(target, rel),
+                     compress_type=zipfile.ZIP_STORED if rel.lower().endswith(STORED) else zipfile.ZIP_DEFLATED)
+    os.replace(f'{dest}.part', dest)
+    return os.path.getsize(dest)
+
+def write_archive_bundle(dest, name, targets):
+    ''' Pack every target archive into {dest}/{name}.zip without recompressing them '''
+    path = os.path.join(dest, f'{name}.zip')
+    with zipfile.ZipFile(f'{path}.part', 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for target in sorted(targets):
+            zf.write(os.path.join(dest, targets[target]['archive']), targets[target]['archive'])
+    os.replace(f'{path}.part', path)
+    return path
+
+def run_archive(args):
+    ''' Archive every target folder in args.outdir into {archive.dest}/{target}.zip.
+
+    Targets are compressed in parallel on archive.workers processes, each
+    streaming its files straight into its own zip. {dest}/index.json keeps
+    each target's file signature, so a rerun only re-archives targets whose
+    selected files changed (or the filters did) and removes archives of
+    targets that are gone. With archive.bundle, the target zips are also
+    stored uncompressed in one {dest}/{name}.zip.
+    '''
+    archive = archive_config(args)
+    dest = archive.dest
+    os.makedirs(dest, exist_ok=True)
+    index_file = os.path.join(dest, 'index.json')
+    index = {'targets': {}}
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            index = json.load(f)
+    filters = {'include': archive.include, 'exclude': archive.exclude, 'max_rank': archive.max_rank}
+
+    folders = sorted(os.path.join(args.outdir, d) for d in os.listdir(args.outdir)
+                     if not d.startswith(('.', '_')) and os.path.isdir(os.path.join(args.outdir, d))
+                     and os.path.abspath(os.path.join(args.outdir, d)) != os.path.abspath(dest))
+    todo, targets = {}, {}
+    for folder in folders:
+        target = os.path.basename(folder)
+        files = target_files(folder, archive.include, archive.exclude, archive.max_rank)
+        if not files:
+            continue
+        sig = signature(files, filters)
+        known = index['targets'].get(target)
+        if known is not None and known['signature'] == sig and os.path.exists(os.path.join(dest, known['archive'])):
+            targets[target] = known
+        else:
+            todo[target] = (folder, files, sig)
+
+    for target in set(index['targets']) - set(targets) - set(todo):
+        old = os.path.join(dest, index['targets'][target]['archive'])
+        if os.path.exists(old):
+            os.remove(old)
+        print(f'Removed archive of {target}')
+
+    if todo:
+        workers = min(archive.workers or available_cpus(), len(todo))
+        # largest targets first so one big target does not finish last on its own
+        order = sorted(todo, key=lambda t: -sum(size for _, size, _ in todo[t][1]))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = {executor.submit(archive_target, todo[t][0], os.path.join(dest, f'{t}.zip'), todo[t][1], archive.level): t
+                       for t in order}
+            for future in as_completed(futures):
+                target = futures[future]
+                _, files, sig = todo[target]
+                targets[target] = {'archive': f'{target}.zip', 'signature': sig, 'n_files': len(files),
+                                   'bytes_in': sum(size for _, size, _ in files), 'bytes_out': future.result()}
+                print(f"Archived {target}: {len(files)} files, {targets[target]['bytes_in'] / 1e6:.1f} MB -> "
+                      f"{targets[target]['bytes_out'] / 1e6:.1f} MB")
+
+    changed = bool(todo) or set(targets) != set(index['targets'])
+    index = {'outdir': os.path.abspath(args.outdir), 'filters': filters, 'targets': targets}
+    with open(f'{index_file}.part', 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(f'{index_file}.part', index_file)
+    print(f'{len(todo)} of {len(targets)} targets archived in {dest}')
+
+    bundle = os.path.join(dest, f'{archive.name}.zip')
+    if archive.bundle and targets and (changed or not os.path.exists(bundle)):
+        print(f'Created {write_archive_bundle(dest, archive.name, targets)}')
+    return index
@@ -1,50 +1,371 @@
+import os
+import json
+import shutil
 import numpy as np
+from src.utils.msa import *
 from src.utils.seqs import *
+from src.utils.graph import *
 from src.utils.helpers import *
+from src.utils.distances import *
+from src.utils.lsh import *
+from src.utils.reachability import *
+from src.utils.profiles import *
+from src.utils.instrument import *
+from src.utils.manifest import *
+from src.status import *
 from sklearn.cluster import DBSCAN
+from sklearn.metrics import adjusted_rand_score
 
-def cluster_DBSCAN(args, df):
+CLUSTER_BACKENDS = {}
+
+def register_backend(name):
+    ''' Register fn(args, codes, sample_weight=None, **kwargs) -> (labels, clusters) as cluster_method name.
+
+    Extra keyword arguments from run_cluster (e.g. report_path) are passed to
+    every backend; backends ignore the ones they do not use.
+    '''
+    def register(fn):
+        CLUSTER_BACKENDS[name] = fn
+        return fn
+    return register
+
+def cluster_labels(labels):
+    ''' Cluster labels in order of first appearance, noise (-1) left out '''
+    _, first = np.unique(labels, return_index=True)
+    return [x for x in labels[np.sort(first)] if x >= 0]
+
+def fit_DBSCAN(codes, eps, min_samples, n_jobs=None, graph=None, sample_weight=None):
+    ''' DBSCAN on uint8 residue codes via a precomputed radius-neighbour graph (reused if given) '''
+    with stage('dbscan_fit', eps=float(eps)) as rec:
+        if graph is None:
+            graph = radius_neighbors_graph(codes, eps, n_jobs=n_jobs)
+        rec.update(n_rows=graph.shape[0], n_edges=graph.nnz)
+        return DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit(graph, sample_weight=sample_weight)
+
+def scan_eps(codes, eps_start, eps_step, min_samples, n_jobs=None, chunk=50, sample_weight=None):
+    ''' Fine eps scan upwards from eps_start until the cluster count stops improving.
+
+    Counts come from one fit_reachability_full over all pairs of rows, which
+    holds for every eps: the scan never builds a radius graph, however far up
+    (and however dense) it has to go.
+    '''
+    with stage('eps_scan_fit', n_rows=len(codes)):
+        reach = fit_reachability_full(codes, min_samples, sample_weight, n_jobs)
+    eps_to_try = eps_start
+    scanner, best_n, best_eps = 0, 0, 0
+    while True:
+        candidates = []
+        for _ in range(chunk):
+            eps_to_try = eps_to_try + eps_step
+            candidates.append(eps_to_try)
+        with stage('eps_scan_chunk', eps_from=float(candidates[0]), eps_to=float(candidates[-1])) as rec:
+            rec['n_clusters'] = count_reachability_clusters(reach, candidates)
+        for eps, n_clust in zip(candidates, rec['n_clusters']):
+            if n_clust > best_n:
+                best_n = n_clust
+                scanner = 1
+                best_eps = eps
+            if n_clust == best_n:
+                best_eps = eps
+                scanner = scanner + 1
+            if n_clust > 0:
+                scanner = scanner + 1
+            if scanner >= 50:
+                return best_eps
+
+def kdist_knee(kdist):
+    ''' Knee of the sorted k-distance curve: the point farthest below the chord joining its ends '''
+    y = np.sort(kdist[np.isfinite(kdist)])
+    if len(y) < 3 or y[-1] == y[0]:
+        return float(y[-1]) if len(y) else np.inf
+    x = np.linspace(0, 1, len(y))
+    return float(y[np.argmax(x - (y - y[0]) / (y[-1] - y[0]))])
+
+def eps_fraction(args, dbscan, weights, cap=None):
+    ''' Fraction of the (weighted) MSA that eps is estimated on: gap_cutoff, capped at dbscan.eps_sample rows '''
+    cap = getattr(dbscan, 'eps_sample', None) if cap is None else cap
+    if cap is None:
+        return args.gap_cutoff
+    return min(args.gap_cutoff, cap / weights.sum())
+
+def select_eps(dbscan, codes, weights, fraction, n_jobs=None, scan_full=True, sweep=sweep_eps, rng=None):
+    ''' Estimate eps on one seeded, thinned subsample of the (weighted) MSA.
+
+    dbscan.eps_method picks the estimate:
+      "knee": knee of the k-distance curve (k = min_samples), from one kNN pass;
+      "max_clusters": eps_test_vals value maximising the cluster count, falling
+        back to the knee when the count peaks at the smallest value;
+      "sweep" (default): like max_clusters, but falls back to scan_eps on all
+        rows (or on the subsample when scan_full is False).
+    sweep maps (graph, eps_vals, min_samples, weights, n_jobs) to cluster counts.
+    '''
+    method = getattr(dbscan, 'eps_method', 'sweep')
+    with stage('eps_estimate', method=method, n_rows=len(codes)) as rec:
+        eps = _select_eps(method, dbscan, codes, weights, fraction, n_jobs, scan_full, sweep, rng, rec)
+        rec['eps'] = float(eps)
+    return eps
+
+def _select_eps(method, dbscan, codes, weights, fraction, n_jobs, scan_full, sweep, rng, rec):
+    rng = np.random.default_rng() if rng is None else rng
+    # thin each row's multiplicity so the subsample matches sampling the expanded MSA
+    test_weights = rng.binomial(weights, fraction)
+    testset, test_weights = codes[test_weights > 0], test_weights[test_weights > 0]
+    rec['n_sample'] = len(testset)
+    knee = lambda: float(np.clip(kdist_knee(knn_distances(testset, dbscan.min_samples, test_weights, n_jobs=n_jobs)),
+                                 dbscan.min_eps, dbscan.max_eps))
+    if method == 'knee':
+        return knee()
+    if method not in ('sweep', 'max_clusters'):
+        raise ValueError(f"Unknown eps_method {method}")
+
+    eps_test_vals = np.arange(dbscan.min_eps, dbscan.max_eps + dbscan.eps_step, dbscan.eps_step)
+    test_graph = radius_neighbors_graph(testset, eps_test_vals.max(), n_jobs=n_jobs)
+    n_clusters = sweep(test_graph, eps_test_vals, dbscan.min_samples, test_weights, n_jobs)
+    rec.update(candidates=eps_test_vals.tolist(), n_clusters=list(n_clusters))
+
+    if np.argmax(n_clusters) != 0:
+        return eps_test_vals[np.argmax(n_clusters)]
+    if method == 'max_clusters':
+        return knee()
+    if scan_full:
+        return scan_eps(codes, dbscan.min_eps, dbscan.eps_step/2, dbscan.min_samples, n_jobs, sample_weight=weights)
+    return scan_eps(testset, dbscan.min_eps, dbscan.eps_step/2, dbscan.min_samples, n_jobs, sample_weight=test_weights)
+
+@register_backend("dbscan")
+def cluster_DBSCAN(args, codes, sample_weight=None, **kwargs):
+    dbscan = dict_to_namespace(args.dbscan)
+    n_jobs = getattr(dbscan, 'n_jobs', None)
+    weights = np.ones(len(codes), dtype=np.int64) if sample_weight is None else np.asarray(sample_weight)
+    if weights.sum() < int(dbscan.min_samples):
+        raise ValueError('Not enough sequences in MSA compared to min_samples')
+    if dbscan.eps_val is None:
+        eps_to_select = select_eps(dbscan, codes, weights, eps_fraction(args, dbscan, weights), n_jobs,
+                                   rng=np.random.default_rng(getattr(args, 'random_seed', None)))
+    else:
+        eps_to_select = dbscan.eps_val
+
+    clustering = fit_DBSCAN(codes, eps_to_select, dbscan.min_samples, n_jobs, sample_weight=weights)
+
+    labels = clustering.labels_
+    clusters = cluster_labels(labels)
+
+    return labels, clusters
+
+def lsh_agreement(codes, graph, eps, min_samples, weights, size, rng, n_jobs=None):
+    ''' Compare an approximate graph with the exact one on a random subsample of size rows.
+
+    Reports the fraction of exact neighbour pairs the approximate graph found
+    and the ARI between exact and approximate DBSCAN labels, both restricted
+    to the subsample (min_samples and weights unchanged).
+    '''
+    sub = np.sort(rng.choice(len(codes), min(size, len(codes)), replace=False))
+    exact = radius_neighbors_graph(codes[sub], eps, n_jobs=n_jobs)
+    approx = graph[sub][:, sub]
+    n_exact = exact.nnz - len(sub)
+    labels_exact = fit_DBSCAN(None, eps, min_samples, graph=exact, sample_weight=weights[sub]).labels_
+    labels_approx = fit_DBSCAN(None, eps, min_samples, graph=approx, sample_weight=weights[sub]).labels_
+    return {'n_sampled': int(len(sub)),
+            'edge_recall': float((approx.nnz - len(sub)) / n_exact) if n_exact else 1.0,
+            'ari': float(adjusted_rand_score(labels_exact, labels_approx)),
+            'n_clusters_exact': int(len(set(labels_exact) - {-1})),
+            'n_clusters_approx': int(len(set(labels_approx) - {-1}))}
+
+@register_backend("dbscan_lsh")
+def cluster_DBSCAN_LSH(args, codes, sample_weight=None, report_path=None, **kwargs):
+    ''' DBSCAN over an approximate (LSH) radius-neighbour graph, for MSAs too large for the exact graph.
+
+    eps is chosen as in cluster_DBSCAN but on a subsample capped at
+    dbscan_lsh.eps_sample rows; the final graph comes from lsh_radius_graph
+    with dbscan_lsh.n_tables hash tables (more tables: higher recall, slower).
+    Unless report_size is 0, an agreement report against exact DBSCAN on a
+    subsample is printed and written to report_path.
+    '''
     dbscan = dict_to_namespace(args.dbscan)
-    L = len(df.sequence.iloc[0])
-    n_clusters=[]
-    ohe_seqs = encode_seqs(df.sequence.tolist(), max_len=L)
-    if len(df.sequence) < int(dbscan.min_samples):
-        exit('Not enough sequences in MSA compared to min_samples. Exiting...')
+    lsh = dict_to_namespace(getattr(args, 'dbscan_lsh', None) or {})
+    n_jobs = getattr(dbscan, 'n_jobs', None)
+    rng = np.random.default_rng(getattr(args, 'random_seed', None))
+    weights = np.ones(len(codes), dtype=np.int64) if sample_weight is None else np.asarray(sample_weight)
+    if weights.sum() < int(dbscan.min_samples):
+        raise ValueError('Not enough sequences in MSA compared to min_samples')
     if dbscan.eps_val is None:
-        eps_test_vals = np.arange(dbscan.min_eps, dbscan.max_eps + dbscan.eps_step, dbscan.eps_step)
-        for eps in eps_test_vals:
-            testset = encode_seqs(df.sample(frac=args.gap_cutoff).sequence.tolist(), max_len=L)
-            clustering = DBSCAN(eps=eps, min_samples=dbscan.min_samples).fit(testset)
-            n_clust = len(set(clustering.labels_))
-            n_not_clustered = len(clustering.labels_[np.where(clustering.labels_==-1)])
-            n_clusters.append(n_clust)
-
-        eps_to_select = eps_test_vals[np.argmax(n_clusters)]
-        if np.argmax(n_clusters) == 0:
-            eps_to_try = dbscan.min_eps
-            scanner, best_n, best_eps = 0, 0, 0
-            while scanner < 50:
-                eps_to_try = eps_to_try + dbscan.eps_step/2
-                clustering = DBSCAN(eps=eps_to_try, min_samples=dbscan.min_samples).fit(ohe_seqs)
-                n_clust = len(set(clustering.labels_))
-                n_not_clustered = len(clustering.labels_[np.where(clustering.labels_==-1)])
-                if n_clust > best_n:
-                    best_n = n_clust
-                    scanner = 1
-                    best_eps = eps_to_try
-                if n_clust == best_n:
-                    best_eps = eps_to_try
-                    scanner = scanner + 1
-                if n_clust > 0:
-                    scanner = scanner + 1
-            eps_to_select = best_eps
+        fraction = eps_fraction(args, dbscan, weights, cap=getattr(lsh, 'eps_sample', 20000))
+        eps_to_select = select_eps(dbscan, codes, weights, fraction, n_jobs, scan_full=False, rng=rng)
+    else:
+        eps_to_select = dbscan.eps_val
+
+    with stage('lsh_graph', eps=float(eps_to_select), n_rows=len(codes)) as rec:
+        graph = lsh_radius_graph(codes, eps_to_select, n_tables=getattr(lsh, 'n_tables', 8), n_cols=getattr(lsh, 'n_cols', None),
+                                 max_bucket=getattr(lsh, 'max_bucket', 512), rng=rng, n_jobs=n_jobs)
+        rec['n_edges'] = graph.nnz
+    clustering = fit_DBSCAN(codes, eps_to_select, dbscan.min_samples, n_jobs, graph=graph, sample_weight=weights)
 
+    labels = clustering.labels_
+    clusters = cluster_labels(labels)
+
+    report_size = getattr(lsh, 'report_size', 2000)
+    if report_size:
+        with stage('lsh_report', n_sampled=min(report_size, len(codes))) as rec:
+            report = {'eps': float(eps_to_select), 'n_rows': int(len(codes)), 'n_clusters': len(clusters),
+                      **lsh_agreement(codes, graph, eps_to_select, dbscan.min_samples, weights, report_size, rng, n_jobs)}
+            rec.update(edge_recall=report['edge_recall'], ari=report['ari'])
+        print(f"LSH agreement on {report['n_sampled']} rows: edge recall {report['edge_recall']:.3f}, ARI {report['ari']:.3f}")
+        if report_path is not None:
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    return labels, clusters
+
+@register_backend("reachability")
+def cluster_reachability(args, codes, sample_weight=None, **kwargs):
+    ''' DBSCAN labels via mutual-reachability spanning forests (OPTICS/HDBSCAN-style).
+
+    eps is selected as for dbscan; the final labels at the chosen eps are
+    extracted from one fit on all rows instead of a DBSCAN fit, and are
+    identical to DBSCAN's.
+    '''
+    dbscan = dict_to_namespace(args.dbscan)
+    n_jobs = getattr(dbscan, 'n_jobs', None)
+    weights = np.ones(len(codes), dtype=np.int64) if sample_weight is None else np.asarray(sample_weight)
+    if weights.sum() < int(dbscan.min_samples):
+        raise ValueError('Not enough sequences in MSA compared to min_samples')
+    if dbscan.eps_val is None:
+        eps_to_select = select_eps(dbscan, codes, weights, eps_fraction(args, dbscan, weights), n_jobs,
+                                   sweep=sweep_reachability, rng=np.random.default_rng(getattr(args, 'random_seed', None)))
     else:
         eps_to_select = dbscan.eps_val
+    with stage('reachability_fit', eps=float(eps_to_select)) as rec:
+        graph = radius_neighbors_graph(codes, eps_to_select, n_jobs=n_jobs)
+        labels = reachability_labels(fit_reachability(graph, dbscan.min_samples, weights), graph, eps_to_select)
+        rec.update(n_rows=graph.shape[0], n_edges=graph.nnz)
+    clusters = cluster_labels(labels)
+
+    return labels, clusters
+
+def get_labels(args, codes, sample_weight=None, **kwargs):
+    if args.cluster_method not in CLUSTER_BACKENDS:
+        raise ValueError(f"Unknown clustering method {args.cluster_method}")
+    with stage('cluster', method=args.cluster_method, n_rows=len(codes)) as rec:
+        labels, clusters = CLUSTER_BACKENDS[args.cluster_method](args, codes, sample_weight=sample_weight, **kwargs)
+        rec['n_clusters'] = len(clusters)
+    return labels, clusters
+
+def cluster_name(args, clust):
+    return f"{args.keyword}_{clust:03d}"
+
+def summarize_clusters(args, codes, labels, clusters, sample_weight):
+    ''' Profile every cluster and, with cluster_prune enabled, merge or drop redundant ones.
+
+    Clusters are visited largest first; one whose consensus sequence is at
+    least cluster_prune.identity identical to that of a kept cluster is
+    merged into it (mode "merge") or left out (mode "skip"). Returns the new
+    labels, the kept clusters and a summary with every kept cluster's size
+    (rows with multiplicity), unique rows, diversity (mean column entropy of
+    its profile) and consensus, and what was pruned.
+    '''
+    prune = dict_to_namespace(getattr(args, 'cluster_prune', None) or {'enabled': False})
+    weights = np.asarray(sample_weight, dtype=np.float64)
+    with stage('summarize_clusters', n_clusters=len(clusters)) as rec:
+        clustered = labels >= 0
+        sizes = np.bincount(labels[clustered], weights=weights[clustered], minlength=max(clusters, default=-1) + 1)
+        profiles = cluster_profiles(codes, labels, clusters, weights)
+        pruned = {}
+        if prune.enabled and len(clusters) > 1:
+            order = np.argsort(-sizes[clusters], kind='stable')
+            redundant = redundant_clusters(profiles.argmax(axis=2), order, prune.identity)
+            remap = np.arange(len(sizes))
+            for k, (j, identity) in redundant.items():
+                remap[clusters[k]] = clusters[j] if prune.mode == 'merge' else -1
+                pruned[cluster_name(args, clusters[k])] = {'redundant_with': cluster_name(args, clusters[j]),
+                                                           'identity': identity, 'action': prune.mode}
+            labels = np.where(clustered, remap[np.maximum(labels, 0)], -1)
+            clusters = [c for k, c in enumerate(clusters) if k not in redundant]
+            if redundant:
+                clustered = labels >= 0
+                sizes = np.bincount(labels[clustered], weights=weights[clustered], minlength=len(sizes))
+                profiles = cluster_profiles(codes, labels, clusters, weights)
+        rec.update(n_pruned=len(pruned), n_kept=len(clusters))
+
+    n_unique = np.bincount(labels[labels >= 0], minlength=len(sizes))
+    diversity = profile_entropy(profiles)
+    alphabet = np.frombuffer(ALPHABET.encode(), dtype=np.uint8)
+    summary = {'clusters': {cluster_name(args, c): {'size': int(sizes[c]), 'n_unique': int(n_unique[c]),
+                                                    'diversity': float(diversity[k]),
+                                                    'consensus': alphabet[profiles[k].argmax(axis=1)].tobytes().decode()}
+                            for k, c in enumerate(clusters)},
+               'pruned': pruned}
+    return labels, clusters, summary
+
+def get_cache(args):
+    if getattr(args, 'cache', None) is None:
+        return None
+    cache = dict_to_namespace(args.cache)
+    if not cache.enabled:
+        return None
+    root = cache.dir or os.path.join(args.tmpdir, 'msa_cache')
+    return ArrayCache(root, max_bytes=int(float(cache.max_gb) * 2**30))
+
+def run_cluster(args, subfolder, input):
+    ''' Cluster input into subfolder/clusters, unless the manifest shows they are current '''
+    with reporting(args, os.path.join(subfolder, 'run_report.jsonl'), target=args.keyword), stage('run_cluster') as rec:
+        manifest = Manifest(subfolder)
+        rec['skipped'] = clusters_current(args, subfolder, input, manifest)
+        if rec['skipped']:
+            print(f'Clusters for {args.keyword} are up to date, skipping')
+            return
+        _run_cluster(args, subfolder, input, manifest)
+
+def _run_cluster(args, subfolder, input, manifest):
+    inputs = {'a3m': manifest.digest(input)}
+    cluster_dir = os.path.join(subfolder, "clusters")
+    shutil.rmtree(cluster_dir, ignore_errors=True)  # clusters of an earlier run would be predicted too
+    manifest.invalidate('cluster')
+    with open(f"{subfolder}/{args.keyword}.log", "w") as f:
+        query, msa = load_filtered_a3m(input, args.gap_cutoff, cache=get_cache(args))
+        f.write(f"Filtered sequences by gap_cutoff={args.gap_cutoff}\n")
+
+        with stage('dedup', n_rows=len(msa)) as rec:
+            uniq, inverse, counts = collapse_duplicates(msa.codes)
+            rec['n_unique'] = len(uniq)
+        f.write(f"Collapsed {len(msa)} sequences to {len(uniq)} unique\n")
 
-    clustering = DBSCAN(eps=eps_to_select, min_samples=dbscan.min_samples).fit(ohe_seqs)
+        codes = msa[uniq].codes
+        labels, clusters = get_labels(args, codes, sample_weight=counts,
+                                      report_path=os.path.join(subfolder, f"{args.keyword}.lsh_report.json"))
+        f.write(f"Found {len(clusters)} clusters using {args.cluster_method}\n")
+        labels, clusters, summary = summarize_clusters(args, codes, labels, clusters, counts)
+        if summary['pruned']:
+            f.write(f"Pruned {len(summary['pruned'])} redundant clusters, {len(clusters)} left\n")
 
-    df['dbscan_label'] = clustering.labels_
-    clusters = [x for x in df.dbscan_label.unique() if x>=0]
+        with stage('write_clusters', n_clusters=len(clusters)) as rec:
+            os.makedirs(cluster_dir, exist_ok=True)
+            pack = getattr(args, 'cluster_bundle', False)
+            chunks, outputs = [], {}
+            header = query.format()
+            for clust, members in msa.groups(labels[inverse], clusters):
+                name = cluster_name(args, clust)
+                chunk = header + members.format()
+                rec['bytes'] = rec.get('bytes', 0) + len(chunk)
+                path = os.path.join(cluster_dir, f"{name}.a3m")
+                with open(path, "wb") as out:
+                    out.write(chunk)
+                outputs[path] = manifest.fingerprint(path, data=chunk)
+                if pack:
+                    chunks.append((name, chunk))
+                f.write(f"Wrote {cluster_dir}/{name}.a3m (n={len(members) + 1})\n")
 
-    return df, clusters
\ No newline at end of file
+            bundle = os.path.join(subfolder, "clusters.bundle")
+            if pack:
+                write_bundle(bundle, chunks)
+                outputs.update({p: manifest.fingerprint(p) for p in [bundle, f"{bundle}.json"]})
+                f.write(f"Wrote {bundle} ({len(chunks)} clusters)\n")
+            else:
+                for stale in [bundle, f"{bundle}.json"]:
+                    if os.path.exists(stale):
+                        os.remove(stale)
+            summary_file = os.path.join(cluster_dir, "summary.json")
+            with open(summary_file, "w") as out:
+                json.dump(summary, out, indent=1)
+            outputs[summary_file] = manifest.fingerprint(summary_file)
+        open(os.path.join(cluster_dir, ".done"), "w").close()
+    manifest.record('cluster', inputs, cluster_config(args), outputs)
+    os.remove(f"{subfolder}/{args.keyword}.log")
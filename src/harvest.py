@@ -0,0 +1,161 @@
+import os
+import re
+import glob
+import json
+import numpy as np
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from src.utils.helpers import *
+from src.utils.instrument import *
+
+_SCORES = re.compile(r'_scores_(rank_(\d+)_(.+)_model_(\d+)_seed_(\d+))\.json$')
+_COLUMNS = {'cluster': str, 'seed': np.int32, 'rank': np.int32, 'model': np.int32, 'model_type': str,
+            'mean_plddt': np.float32, 'ptm': np.float32, 'iptm': np.float32, 'max_pae': np.float32, 'mean_pae': np.float32,
+            'cluster_size': np.int32, 'done_mtime': np.float64, 'pdb': str}  # pdb: path relative to the target folder
+
+def ca_coords(pdb):
+    ''' C-alpha coordinates of the first model in a PDB file (n_res x 3 float32) '''
+    xyz = []
+    with open(pdb) as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if line.startswith('ATOM') and line[12:16] == ' CA ':
+                xyz.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return np.array(xyz, dtype=np.float32).reshape(-1, 3)
+
+def finished_runs(pred_dir):
+    ''' {(cluster, seed): (seed dir, done-file mtime)} for every prediction with a done file '''
+    runs = {}
+    for done in glob.glob(os.path.join(pred_dir, '*', 's*', '*_0.done.txt')):
+        seed_dir = os.path.dirname(done)
+        cluster = os.path.basename(os.path.dirname(seed_dir))
+        runs[(cluster, int(os.path.basename(seed_dir)[1:]))] = (seed_dir, os.path.getmtime(done))
+    return runs
+
+def harvest_run(seed_dir, cluster, seed, done_mtime, cluster_size, coords=True):
+    ''' One row per model in a finished preds/{cluster}/s{seed} directory, plus per-residue pLDDT and optionally CA coordinates '''
+    rows, plddt, xyz = [], [], []
+    for scores in sorted(glob.glob(os.path.join(seed_dir, f'{cluster}_0_scores_*.json'))):
+        match = _SCORES.search(scores)
+        if match is None:
+            continue
+        tag, rank, model_type, model, _ = match.groups()
+        with open(scores) as f:
+            s = json.load(f)
+        pae = np.asarray(s.get('pae', []), dtype=np.float32)
+        pdb = next((p for p in [os.path.join(seed_dir, f'{cluster}_0_{kind}_{tag}.pdb') for kind in ('relaxed', 'unrelaxed')]
+                    if os.path.exists(p)), '')
+        rows.append((cluster, seed, int(rank), int(model), model_type, float(np.mean(s['plddt'])),
+                     s.get('ptm', np.nan), s.get('iptm', np.nan), s.get('max_pae', np.nan),
+                     float(pae.mean()) if pae.size else np.nan, cluster_size, done_mtime,
+                     os.path.join('preds', cluster, f's{seed}', os.path.basename(pdb)) if pdb else ''))
+        plddt.append(np.asarray(s['plddt'], dtype=np.float32))
+        if coords:
+            xyz.append(ca_coords(pdb) if pdb else np.zeros((0, 3), dtype=np.float32))
+    return rows, plddt, xyz
+
+def _stack(arrays, tail=()):
+    ''' Stack ragged per-model arrays into one NaN-padded array '''
+    n_res = max((len(a) for a in arrays), default=0)
+    out = np.full((len(arrays), n_res) + tail, np.nan, dtype=np.float32)
+    for i, a in enumerate(arrays):
+        out[i, :len(a)] = a
+    return out
+
+def _table(results, coords):
+    rows = [row for r in results for row in r[0]]
+    if not rows:
+        return {}
+    table = {col: np.array(values, dtype=dtype) for (col, dtype), values in zip(_COLUMNS.items(), zip(*rows))}
+    table['plddt'] = _stack([p for r in results for p in r[1]])
+    if coords:
+        table['coords'] = _stack([x for r in results for x in r[2]], (3,))
+    return table
+
+def _concat(tables):
+    ''' Append tables row-wise, NaN-padding per-residue arrays to the longest chain '''
+    tables = [t for t in tables if t]
+    if not tables:
+        return {}
+    out = {}
+    for k in tables[0]:
+        parts = [t[k] for t in tables]
+        if parts[0].ndim > 1:
+            n_res = max(p.shape[1] for p in parts)
+            parts = [np.pad(p, [(0, 0), (0, n_res - p.shape[1])] + [(0, 0)] * (p.ndim - 2), constant_values=np.nan)
+                     for p in parts]
+        out[k] = np.concatenate(parts)
+    return out
+
+def cluster_sizes(subfolder):
+    ''' Rows per cluster from clusters/summary.json, or counted from the cluster a3ms '''
+    summary_file = os.path.join(subfolder, 'clusters', 'summary.json')
+    if os.path.exists(summary_file):
+        with open(summary_file) as f:
+            return {name: c['size'] for name, c in json.load(f)['clusters'].items()}
+    sizes = {}
+    for fil in glob.glob(os.path.join(subfolder, 'clusters', '*.a3m')):
+        with open(fil, 'rb') as f:
+            sizes[os.path.splitext(os.path.basename(fil))[0]] = f.read().count(b'>') - 1  # minus the query
+    return sizes
+
+def harvest_pool(args, workers=None):
+    ''' Process pool for run_harvest; spawned, as harvesting may run next to the pipeline's threads '''
+    harvest = dict_to_namespace(getattr(args, 'harvest', None) or {})
+    return ProcessPoolExecutor(max_workers=workers or getattr(harvest, 'workers', None) or available_cpus(),
+                               mp_context=multiprocessing.get_context('spawn'))
+
+def load_harvest(path):
+    ''' The harvest table at path as a dict of column arrays (plddt: models x residues, coords: models x residues x 3) '''
+    with np.load(path, allow_pickle=False) as table:
+        return {k: table[k] for k in table.files}
+
+def run_harvest(args, subfolder, pool=None):
+    ''' Collect scores (and CA coordinates) of every finished prediction into {subfolder}/{keyword}.models.npz.
+
+    Incremental: models whose done file is unchanged are kept from the
+    existing table, new or redone (cluster, seed) directories are parsed on
+    a process pool (pool, or a new one of harvest.workers processes), and
+    runs that disappeared are dropped.
+    '''
+    with reporting(args, os.path.join(subfolder, 'run_report.jsonl'), target=args.keyword), stage('harvest') as rec:
+        harvest = dict_to_namespace(getattr(args, 'harvest', None) or {})
+        coords = getattr(harvest, 'coords', True)
+        path = os.path.join(subfolder, f'{args.keyword}.models.npz')
+        runs = finished_runs(os.path.join(subfolder, 'preds'))
+
+        table = load_harvest(path) if os.path.exists(path) else {}
+        if coords and table and 'coords' not in table:
+            table = {}  # coordinates were not harvested before
+        keep = np.array([runs.get((c, int(i)), (None, None))[1] == m
+                         for c, i, m in zip(table.get('cluster', []), table.get('seed', []), table.get('done_mtime', []))], dtype=bool)
+        table = {k: v[keep] for k, v in table.items()}
+        kept = set(zip(table.get('cluster', []), map(int, table.get('seed', []))))
+        todo = [(key, run) for key, run in sorted(runs.items()) if key not in kept]
+        rec.update(n_runs=len(runs), n_new=len(todo), n_dropped=int((~keep).sum()))
+        if not todo and keep.all():
+            rec['n_models'] = len(table.get('cluster', []))
+            return path if table else None
+
+        results = []
+        if todo:
+            sizes = cluster_sizes(subfolder)
+            workers = min(getattr(harvest, 'workers', None) or available_cpus(), len(todo))
+            with (nullcontext(pool) if pool is not None else harvest_pool(args, workers)) as executor:
+                results = list(executor.map(harvest_run, [run[0] for _, run in todo], [key[0] for key, _ in todo],
+                                            [key[1] for key, _ in todo], [run[1] for _, run in todo],
+                                            [sizes.get(key[0], -1) for key, _ in todo], [coords] * len(todo),
+                                            chunksize=max(len(todo) // (4 * workers), 1)))
+        table = _concat([table, _table(results, coords)])
+        if not table:
+            if os.path.exists(path):
+                os.remove(path)
+            return None
+
+        with open(f'{path}.part', 'wb') as f:
+            np.savez(f, **table)
+        os.replace(f'{path}.part', path)
+        rec['n_models'] = len(table['cluster'])
+    return path
@@ -0,0 +1,171 @@
+import os
+import copy
+import queue
+import threading
+import traceback
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from src.cluster import *
+from src.search import *
+from src.predict import *
+from src.harvest import *
+from src.utils.helpers import *
+
+_DONE = None
+
+def target_args(args, id_):
+    args = copy.copy(args)
+    args.keyword = id_
+    return args
+
+def msa_path(args, id_):
+    return os.path.join(args.outdir, id_, f'{id_}.a3m')
+
+def cluster_target(args, id_):
+    ''' Clustering stage for one target (runs in a worker process) '''
+    subfolder = os.path.join(args.outdir, id_)
+    run_cluster(target_args(args, id_), subfolder, msa_path(args, id_))
+
+def _msa_stage(args, targets, out_q, workers, failures):
+    ''' Hand on targets whose a3m is current, then generate the rest in msa_batch_size chunks on I/O threads '''
+    todo = []
+    for id_, seq_ in targets:
+        if msa_current(args, id_, seq_):
+            out_q.put(id_)
+        else:
+            todo.append((id_, seq_))
+    batch_size = getattr(args, 'msa_batch_size', None) or max(len(todo), 1)
+    batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(generate_msas, args, [t[0] for t in b], [t[1] for t in b]): b for b in batches}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except BaseException:
+                    failures.extend((id_, 'msa', traceback.format_exc()) for id_, _ in futures[future])
+                    continue
+                for id_, _ in futures[future]:
+                    out_q.put(id_)
+    finally:
+        out_q.put(_DONE)
+
+def _cluster_stage(args, in_q, out_q, workers, failures):
+    ''' Cluster targets on a process pool, at most `workers` at a time, passing finished ones on.
+
+    A worker that dies (killed for memory, crashed) breaks the whole pool: the
+    pool is replaced and the targets that were running on it are retried once,
+    so one bad target is recorded as failed without taking the others along.
+    '''
+    # spawn: forking while the MSA threads run could inherit held locks
+    new_pool = lambda: ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    pool, running, retried = new_pool(), {}, set()
+
+    def submit(id_):
+        nonlocal pool
+        try:
+            future = pool.submit(cluster_target, args, id_)
+        except BrokenProcessPool:
+            pool.shutdown(wait=False)
+            pool = new_pool()
+            future = pool.submit(cluster_target, args, id_)
+        running[future] = (id_, pool)
+
+    def collect(timeout):
+        nonlocal pool
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        retry = []
+        for future in done:
+            id_, owner = running.pop(future)
+            try:
+                future.result()
+                out_q.put(id_)
+            except BrokenProcessPool:
+                if owner is pool:
+                    pool.shutdown(wait=False)
+                    pool = new_pool()
+                if id_ in retried:
+                    failures.append((id_, 'cluster', traceback.format_exc()))
+                else:
+                    retried.add(id_)
+                    retry.append(id_)
+            except BaseException:
+                failures.append((id_, 'cluster', traceback.format_exc()))
+        for id_ in retry:
+            submit(id_)
+
+    try:
+        finished = False
+        while not finished:
+            try:
+                id_ = in_q.get(timeout=0.5)
+            except queue.Empty:
+                collect(0)
+                continue
+            if id_ is _DONE:
+                finished = True
+            elif clusters_current(target_args(args, id_), os.path.join(args.outdir, id_), msa_path(args, id_)):
+                out_q.put(id_)
+            else:
+                submit(id_)
+            while len(running) >= workers:
+                collect(None)
+            collect(0)
+        while running:
+            collect(None)
+    finally:
+        pool.shutdown(cancel_futures=True)
+        out_q.put(_DONE)
+
+def run_pipeline(args, ids, seqs):
+    ''' Overlap MSA generation, clustering and prediction across targets.
+
+    MSAs are generated on I/O threads, clustering runs on a process pool and
+    prediction on the calling thread (the single GPU consumer); harvesting,
+    if enabled, runs on one more thread so the GPU is not kept waiting.
+    Bounded queues between the stages provide backpressure. Every stage resumes from disk:
+    current a3ms are not searched again, targets whose clusters are current
+    (see Manifest) are not re-clustered, and finished predictions are skipped
+    via done files.
+    '''
+    pipeline = dict_to_namespace(args.pipeline)
+    msa_q = queue.Queue(maxsize=pipeline.queue_size)
+    pred_q = queue.Queue(maxsize=pipeline.queue_size)
+    failures = []
+    for id_ in ids:
+        os.makedirs(os.path.join(args.outdir, id_), exist_ok=True)
+
+    stages = [threading.Thread(target=_msa_stage, args=(args, list(zip(ids, seqs)), msa_q, pipeline.msa_workers, failures), daemon=True),
+              threading.Thread(target=_cluster_stage, args=(args, msa_q, pred_q, pipeline.cluster_workers, failures), daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    harvest = getattr(args, 'harvest', None) is not None and dict_to_namespace(args.harvest).enabled
+    harvests = {}
+    with ThreadPoolExecutor(max_workers=1) as harvester, (harvest_pool(args) if harvest else nullcontext()) as harvest_procs:
+        while True:
+            id_ = pred_q.get()
+            if id_ is _DONE:
+                break
+            print(f'Running structure prediction for {id_}...')
+            try:
+                run_predictions(target_args(args, id_), os.path.join(args.outdir, id_))
+            except Exception:
+                failures.append((id_, 'predict', traceback.format_exc()))
+                continue
+            if harvest:
+                harvests[harvester.submit(run_harvest, target_args(args, id_), os.path.join(args.outdir, id_), harvest_procs)] = id_
+        for future, id_ in harvests.items():
+            try:
+                future.result()
+            except Exception:
+                failures.append((id_, 'harvest', traceback.format_exc()))
+    for stage in stages:
+        stage.join()
+
+    for id_, stage, tb in failures:
+        print(f'{id_}: {stage} stage failed\n{tb}')
+    if failures:
+        raise RuntimeError(f'{len(failures)} target(s) failed: {", ".join(sorted({f[0] for f in failures}))}')
@@ -0,0 +1,178 @@
+import os
+import glob
+import json
+import heapq
+import math
+import copy
+import shutil
+from src.status import *
+from src.predict import *
+from src.search import *
+from src.utils.a3m import *
+from src.utils.msa import *
+from src.utils.mmseqs import *
+from src.utils.helpers import *
+
+# Cost model defaults, overridden by slurm.cost in the config
+COST = {
+    'default_depth': 5000,        # MSA rows assumed when no MSA is cached
+    'store_ratio': 5.0,           # a3m bytes per gzip byte in the MSA store
+    'rows_per_cluster': 25,       # MSA rows per DBSCAN cluster
+    'max_clusters': 500,
+    'msa_s': 600,                 # search time for a target without an MSA
+    'cluster_s_per_gunit': 0.7,   # clustering seconds per 1e9 rows^2 x columns
+    'predict_base_s': 40,         # seconds per structure (all models) ...
+    'predict_s_per_kres2': 150,   # ... plus this times (length / 1000)^2
+    'startup_s': 120,             # colabfold_batch start-up and model compilation
+    'mem_base_gb': 8,             # colabfold host memory ...
+    'mem_gb_per_kres': 4,         # ... plus this per 1000 residues
+    'cluster_gb_per_mcell': 0.25, # clustering memory per million rows x columns
+}
+
+def cost_model(args):
+    return dict_to_namespace({**COST, **(args.slurm.get('cost') or {})})
+
+def msa_depth(args, id_, seq, store=None, backend=None, cost=None):
+    ''' (rows, source) of the target's MSA: counted from {outdir}/{id}/{id}.a3m, estimated from the MSA store, or assumed '''
+    path = os.path.join(args.outdir, id_, f'{id_}.a3m')
+    if os.path.exists(path):
+        return len(index_records(map_file(path))[0]), 'a3m'
+    if store is not None:
+        size = store.size(store.key(seq, backend))
+        if size is not None:
+            return max(int(size * cost.store_ratio / (len(seq) + 40)), 1), 'store'
+    return cost.default_depth, 'default'
+
+def estimate_target(args, id_, seq, cost, store=None, backend=None):
+    ''' Estimated seconds and memory for one afcluster run, counting only work that is not done yet '''
+    L = len(seq)
+    subfolder = os.path.join(args.outdir, id_)
+    depth, source = msa_depth(args, id_, seq, store, backend, cost)
+    afcluster = dict_to_namespace(args.afcluster)
+    seeds = generate_command(args, return_seeds=True)
+
+    seconds = 0.0 if source == 'a3m' else cost.msa_s
+    target = copy.copy(args)
+    target.keyword = id_
+    if source == 'a3m' and clusters_current(target, subfolder, os.path.join(subfolder, f'{id_}.a3m')):
+        cluster_files = sorted(glob.glob(os.path.join(subfolder, 'clusters', '*.a3m')))
+        n_clusters = len(cluster_files)
+        n_structures = sum(len(m) for m in pending_predictions(os.path.join(subfolder, 'preds'), cluster_files, seeds).values())
+    else:
+        n_clusters = int(min(max(depth // cost.rows_per_cluster, 1), cost.max_clusters))
+        n_structures = n_clusters * seeds
+        seconds += cost.cluster_s_per_gunit * depth ** 2 * L / 1e9
+
+    per_structure = cost.predict_base_s + cost.predict_s_per_kres2 * (L / 1000) ** 2
+    n_starts = (n_structures > 0) if getattr(afcluster, 'backend', 'per_run') == 'batch' else n_structures
+    seconds += n_structures * per_structure + n_starts * cost.startup_s
+
+    cluster_gb = cost.cluster_gb_per_mcell * depth * L / 1e6
+    predict_gb = cost.mem_base_gb + cost.mem_gb_per_kres * L / 1000
+    pipeline = dict_to_namespace(getattr(args, 'pipeline', None) or {'enabled': False})
+    if pipeline.enabled:
+        mem_gb = predict_gb + getattr(pipeline, 'cluster_workers', 1) * cluster_gb
+    else:
+        mem_gb = max(predict_gb, cluster_gb)
+    return {'id': id_, 'length': L, 'depth': depth, 'depth_source': source, 'n_clusters': n_clusters,
+            'n_structures': n_structures, 'est_s': seconds, 'mem_gb': mem_gb}
+
+def pack_shards(costs, n_shards):
+    ''' Longest-processing-time-first packing of costs into n_shards; returns item indices per shard '''
+    heap = [(0.0, k) for k in range(n_shards)]
+    shards = [[] for _ in range(n_shards)]
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        load, k = heapq.heappop(heap)
+        shards[k].append(i)
+        heapq.heappush(heap, (load + costs[i], k))
+    return [s for s in shards if s]
+
+def round_up_tier(value, tiers):
+    ''' Smallest tier >= value (the largest tier if none is) '''
+    return next((t for t in sorted(tiers) if t >= value), max(tiers))
+
+def plan_jobs(args, ids, seqs, n_shards=None):
+    ''' Estimate every target, pack the unfinished ones into shards and size each shard's request.
+
+    Shards with the same memory and time request form one job array.
+    '''
+    slurm = dict_to_namespace(args.slurm)
+    cost = cost_model(args)
+    store = get_msa_store(args)
+    api_kwargs = getattr(args, 'mmseqs_api', None) or {}
+    backend = msa_backend(host_url=api_kwargs.get('host_url', "https://api.colabfold.com")) if store is not None else None
+
+    targets = [estimate_target(args, id_, seq, cost, store, backend) for id_, seq in zip(ids, seqs)]
+    todo = [t for t in targets if t['est_s'] > 0]
+    safety = slurm.safety
+    total = sum(t['est_s'] for t in todo) * safety
+    if n_shards is None:
+        n_shards = math.ceil(total / (slurm.shard_hours * 3600))
+    n_shards = max(min(n_shards, len(todo), slurm.max_array_size), 1)
+
+    shards = []
+    for members in pack_shards([t['est_s'] for t in todo], n_shards) if todo else []:
+        est_s = sum(todo[i]['est_s'] for i in members)
+        hours = (est_s * safety + slurm.shard_setup_s) / 3600
+        if hours > slurm.max_hours:
+            print(f"Warning: shard of {len(members)} targets is estimated at {hours:.0f}h, over max_hours={slurm.max_hours}")
+        shards.append({'targets': [todo[i]['id'] for i in members], 'est_s': est_s,
+                       'hours': min(round_up_tier(hours, slurm.time_tiers_h), slurm.max_hours),
+                       'mem_gb': round_up_tier(max(todo[i]['mem_gb'] for i in members) * safety, slurm.mem_tiers_gb)})
+
+    shards.sort(key=lambda s: (s['mem_gb'], s['hours'], -s['est_s']))
+    arrays = {}
+    for k, shard in enumerate(shards):
+        shard['shard'] = k
+        name = f"afc_{shard['mem_gb']}G_{shard['hours']}h"
+        shard['array'], shard['task'] = name, len(arrays.setdefault(name, []))
+        arrays[name].append(shard)
+    return {'n_targets': len(targets), 'n_done': len(targets) - len(todo), 'est_total_h': total / 3600,
+            'targets': targets, 'shards': shards,
+            'arrays': [{'name': name, 'n_tasks': len(members), 'mem_gb': members[0]['mem_gb'], 'hours': members[0]['hours']}
+                       for name, members in arrays.items()]}
+
+def sbatch_script(slurm, array, shard_list, config, log_dir, root):
+    ''' Array job over the shard FASTAs listed (one per line) in shard_list '''
+    lines = ['#!/bin/bash',
+             f"#SBATCH --job-name={array['name']}",
+             f"#SBATCH --array=0-{array['n_tasks'] - 1}",
+             f"#SBATCH --time={array['hours']}:00:00",
+             f"#SBATCH -p {slurm.partition}",
+             f"#SBATCH --gres={slurm.gres}",
+             f"#SBATCH --mem={array['mem_gb']}G",
+             f"#SBATCH -c {slurm.cpus}",
+             f"#SBATCH --chdir={root}",
+             f"#SBATCH --output={log_dir}/%x_%A_%a.out",
+             f"#SBATCH --error={log_dir}/%x_%A_%a.err"]
+    lines += [f'#SBATCH {opt}' for opt in getattr(slurm, 'options', None) or []]
+    lines += list(getattr(slurm, 'setup', None) or [])
+    lines += [f'FASTA=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {shard_list})',
+              f'python afcluster.py run --input "$FASTA" --config {config}']
+    return '\n'.join(lines) + '\n'
+
+def write_plan(args, plan, ids, seqs, script_dir, config, root):
+    ''' Write a FASTA per shard, a shard list and sbatch script per array, and plan.json; returns the script paths '''
+    slurm = dict_to_namespace(args.slurm)
+    log_dir = os.path.join(script_dir, 'logs')
+    shutil.rmtree(os.path.join(script_dir, 'shards'), ignore_errors=True)  # shards of an earlier plan
+    os.makedirs(os.path.join(script_dir, 'shards'))
+    os.makedirs(log_dir, exist_ok=True)
+    seq_of = dict(zip(ids, seqs))
+    for shard in plan['shards']:
+        shard['fasta'] = os.path.join(script_dir, 'shards', f"shard_{shard['shard']:04d}.fasta")
+        write_fasta(shard['targets'], [seq_of[id_] for id_ in shard['targets']], shard['fasta'])
+
+    scripts = []
+    for array in plan['arrays']:
+        shard_list = os.path.join(script_dir, f"{array['name']}.txt")
+        with open(shard_list, 'w') as f:
+            f.writelines(f"{s['fasta']}\n" for s in plan['shards'] if s['array'] == array['name'])
+        array['script'] = os.path.join(script_dir, f"{array['name']}.sbatch")
+        with open(array['script'], 'w') as f:
+            f.write(sbatch_script(slurm, array, shard_list, config, log_dir, root))
+        scripts.append(array['script'])
+
+    with open(os.path.join(script_dir, 'plan.json'), 'w') as f:
+        json.dump(plan, f, indent=2)
+    return scripts
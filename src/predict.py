@@ -0,0 +1,230 @@
+import os
+import re
+import glob
+import json
+import shutil
+import subprocess
+from functools import lru_cache
+from src.utils.helpers import *
+from src.utils.instrument import *
+from src.utils.manifest import *
+
+@lru_cache(maxsize=None)
+def gpu_available():
+    ''' True if an NVIDIA GPU is visible, checked without importing a CUDA framework '''
+    if os.environ.get('CUDA_VISIBLE_DEVICES') in ('', '-1'):
+        return False
+    return shutil.which('nvidia-smi') is not None and subprocess.run(['nvidia-smi', '-L'], capture_output=True).returncode == 0
+
+def generate_command(args, return_seeds=False):
+    run_command = ['colabfold_batch']
+    afcluster = dict_to_namespace(args.afcluster)
+    if return_seeds:
+        return afcluster.num_seeds
+    if afcluster.amber:
+        run_command.extend(['--amber'])
+        if gpu_available():
+            run_command.extend(['--use-gpu-relax'])
+        run_command.extend(['--num-relax', f'{afcluster.num_relax}'])
+    if afcluster.use_dropout:
+        run_command.extend(['--use-dropout'])
+    run_command.extend(['--num-recycle', f'{afcluster.num_recycle}'])
+    if afcluster.templates:
+        run_command.extend(['--templates'])
+    return run_command
+
+def done_file(pred_dir, fil_name, seed):
+    return f'{pred_dir}/{fil_name}/s{seed}/{fil_name}_0.done.txt'
+
+def pending_predictions(pred_dir, cluster_files, seeds):
+    ''' {cluster a3m: [seeds without a done file]} for every cluster with work left '''
+    pending = {}
+    for fil in cluster_files:
+        fil_name = os.path.splitext(os.path.basename(fil))[0]
+        missing = [i for i in range(seeds) if not os.path.exists(done_file(pred_dir, fil_name, i))]
+        if missing:
+            pending[fil] = missing
+    return pending
+
+def predict_per_run(args, pred_dir, pending):
+    ''' One colabfold_batch process per (cluster, seed), every cluster's first seed before any second seed '''
+    for i in range(generate_command(args, return_seeds=True)):
+        for fil, missing in pending.items():
+            if i not in missing:
+                continue
+            fil_name = os.path.splitext(os.path.basename(fil))[0]
+            os.makedirs(f'{pred_dir}/{fil_name}/s{i}', exist_ok=True)
+
+            run_command = generate_command(args)
+            run_command.extend(['--random-seed', f'{i}'])
+            run_command.extend(['--jobname-prefix', f'{fil_name}'])
+            run_command.extend([f'{fil}', f'{pred_dir}/{fil_name}/s{i}'])
+            with stage('predict_run', cluster=fil_name, seed=i) as rec:
+                rec['returncode'] = subprocess.run(run_command, shell=False).returncode
+
+_RANK = re.compile(r'_rank_(\d+)_')
+
+def _per_seed_ranks(seeded):
+    ''' {batch-wide rank: rank among this seed's models}, keeping the batch order '''
+    ranks = sorted({int(m.group(1)) for m in map(_RANK.search, seeded) if m})
+    return {rank: k for k, rank in enumerate(ranks, 1)}
+
+def _split_batch_outputs(out_dir, pred_dir, pending, jobs):
+    ''' Move one batch run's outputs (named by jobs[cluster]) into preds/{cluster}/s{seed}, named as a per-run job's would be.
+
+    Files become {cluster}_0_..., and each seed's models are renumbered
+    rank_001.. in their batch-wide order.
+    '''
+    files = sorted(os.listdir(out_dir))
+    owned, claimed = {}, set()
+    # longest names first so MAIN_100 does not claim MAIN_1000's files
+    for fil in sorted(pending, key=lambda f: -len(jobs[f])):
+        owned[fil] = [f for f in files if f not in claimed and (f.startswith(f'{jobs[fil]}_') or f.startswith(f'{jobs[fil]}.'))]
+        claimed.update(owned[fil])
+    run_files = [f for f in files if f not in claimed and os.path.isfile(os.path.join(out_dir, f))]  # log.txt, config.json
+
+    for fil, own in owned.items():
+        fil_name, job = os.path.splitext(os.path.basename(fil))[0], jobs[fil]
+        if f'{job}.done.txt' not in own:
+            continue  # prediction failed or was interrupted; stays pending
+        shared = [f for f in own if '_seed_' not in f and f != f'{job}.done.txt']
+        for i in pending[fil]:
+            seed_dir = f'{pred_dir}/{fil_name}/s{i}'
+            os.makedirs(seed_dir, exist_ok=True)
+            seeded = [f for f in own if f'_seed_{i:03d}' in f]
+            if not seeded:
+                continue
+            ranks = _per_seed_ranks(seeded)
+            for f in seeded:
+                name = _RANK.sub(lambda m: f'_rank_{ranks[int(m.group(1))]:03d}_', f'{fil_name}_0' + f[len(job):], count=1)
+                shutil.move(os.path.join(out_dir, f), os.path.join(seed_dir, name))
+            for f in shared:  # files and folders (e.g. {job}_env) like a per-run job's
+                path, dest = os.path.join(out_dir, f), os.path.join(seed_dir, f'{fil_name}_0' + f[len(job):])
+                if os.path.isdir(path):
+                    shutil.copytree(path, dest, dirs_exist_ok=True)
+                else:
+                    shutil.copy2(path, dest)
+            for f in run_files:
+                shutil.copy2(os.path.join(out_dir, f), os.path.join(seed_dir, f))
+            open(done_file(pred_dir, fil_name, i), 'w').close()
+        for f in own:
+            path = os.path.join(out_dir, f)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+def predict_batch(args, pred_dir, pending, jobs=None):
+    ''' A single colabfold_batch process over all pending clusters with --num-seeds.
+
+    Model parameters are loaded and compiled once per target instead of once
+    per (cluster, seed). Every pending cluster is rerun for all seeds, but only
+    missing seeds are placed, so finished predictions are never overwritten.
+    Ranks inside preds/{cluster}/s{seed} follow the batch-wide ranking.
+    colabfold_batch runs its inputs in name order, so jobs maps each cluster
+    to the job name it runs under (by default its own name); see prediction_jobs.
+    '''
+    if not pending:
+        return
+    jobs = jobs or {fil: os.path.splitext(os.path.basename(fil))[0] for fil in pending}
+    batch_dir = os.path.join(pred_dir, '_batch')
+    in_dir, out_dir = os.path.join(batch_dir, 'in'), os.path.join(batch_dir, 'out')
+    shutil.rmtree(in_dir, ignore_errors=True)
+    os.makedirs(in_dir)
+    # outputs left by an interrupted run are only reusable under the same job names
+    jobs_file = os.path.join(batch_dir, 'jobs.json')
+    job_names = {os.path.basename(fil): jobs[fil] for fil in pending}
+    if os.path.exists(jobs_file):
+        with open(jobs_file) as f:
+            previous = json.load(f)
+        if any(previous.get(name, job) != job for name, job in job_names.items()):
+            shutil.rmtree(out_dir, ignore_errors=True)
+    with open(jobs_file, 'w') as f:
+        json.dump(job_names, f)
+    os.makedirs(out_dir, exist_ok=True)
+    for fil in pending:
+        os.symlink(os.path.abspath(fil), os.path.join(in_dir, f'{jobs[fil]}.a3m'))
+
+    run_command = generate_command(args)
+    run_command.extend(['--random-seed', '0'])
+    run_command.extend(['--num-seeds', f'{generate_command(args, return_seeds=True)}'])
+    run_command.extend([in_dir, out_dir])
+    with stage('predict_batch', n_clusters=len(pending), n_runs=sum(len(m) for m in pending.values())) as rec:
+        rec['returncode'] = subprocess.run(run_command, shell=False).returncode
+
+    with stage('predict_split', n_clusters=len(pending)):
+        _split_batch_outputs(out_dir, pred_dir, pending, jobs)
+    if not pending_predictions(pred_dir, list(pending), generate_command(args, return_seeds=True)):
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+def run_predictions(args, subfolder):
+    ''' Predict every cluster a3m for num_seeds seeds in afcluster.order, skipping (cluster, seed) pairs with a done file '''
+    with reporting(args, os.path.join(subfolder, 'run_report.jsonl'), target=args.keyword), stage('run_predictions'):
+        _run_predictions(args, subfolder)
+
+def predict_config(args):
+    ''' The afcluster settings that determine a prediction (num_seeds only adds seeds, backend and order only schedule) '''
+    return {k: v for k, v in args.afcluster.items() if k not in ('num_seeds', 'backend', 'order')}
+
+def cluster_files(subfolder, manifest):
+    ''' Cluster a3ms written by the last clustering run (all of clusters/*.a3m for runs without a manifest) '''
+    outputs = manifest.outputs('cluster')
+    if outputs is None:
+        return sorted(glob.glob(f"{subfolder}/clusters/*.a3m"))
+    return sorted(f for f in outputs if f.endswith('.a3m'))
+
+def order_clusters(subfolder, files, order='size'):
+    ''' files in prediction order: largest ("size") or most diverse ("diversity") cluster first per clusters/summary.json, or by "name" '''
+    summary_file = os.path.join(subfolder, 'clusters', 'summary.json')
+    if order == 'name' or not os.path.exists(summary_file):
+        return sorted(files)
+    if order not in ('size', 'diversity'):
+        raise ValueError(f"Unknown prediction order {order}")
+    with open(summary_file) as f:
+        summary = json.load(f)['clusters']
+    key = lambda fil: -summary.get(os.path.splitext(os.path.basename(fil))[0], {}).get(order, 0)
+    return sorted(sorted(files), key=key)
+
+def prediction_jobs(files):
+    ''' Job name per cluster that makes colabfold_batch's name order follow the order of files '''
+    return {fil: f'{rank:05d}_{os.path.splitext(os.path.basename(fil))[0]}' for rank, fil in enumerate(files)}
+
+def drop_stale_predictions(pred_dir, recorded, inputs, config):
+    ''' Remove predictions made with other afcluster settings, or of clusters whose a3m changed or is gone '''
+    if recorded is None:
+        return
+    if recorded['config'] != config:
+        shutil.rmtree(pred_dir, ignore_errors=True)
+        return
+    for name, digest in recorded['inputs'].items():
+        if inputs.get(name) != digest:
+            shutil.rmtree(os.path.join(pred_dir, name), ignore_errors=True)
+
+def _run_predictions(args, subfolder):
+    pred_dir = os.path.join(subfolder, 'preds')
+    manifest = Manifest(subfolder)
+    files = cluster_files(subfolder, manifest)
+    inputs = {os.path.splitext(os.path.basename(fil))[0]: manifest.digest(fil) for fil in files}
+    config = predict_config(args)
+    drop_stale_predictions(pred_dir, manifest.recorded('predict'), inputs, config)
+    manifest.record('predict', inputs, config, {})
+    os.makedirs(pred_dir, exist_ok=True)
+
+    afcluster = dict_to_namespace(args.afcluster)
+    files = order_clusters(subfolder, files, getattr(afcluster, 'order', 'name'))
+    seeds = generate_command(args, return_seeds=True)
+    pending = pending_predictions(pred_dir, files, seeds)
+    backend = getattr(afcluster, 'backend', 'per_run')
+    with stage('predict', backend=backend, n_clusters=len(pending)):
+        _predict(args, pred_dir, pending, backend, prediction_jobs(files))
+
+    done = [done_file(pred_dir, name, i) for name in inputs for i in range(seeds)]
+    manifest.record('predict', inputs, config, {f: manifest.fingerprint(f) for f in done if os.path.exists(f)})
+
+def _predict(args, pred_dir, pending, backend, jobs=None):
+    if backend == 'batch':
+        predict_batch(args, pred_dir, pending, jobs)
+    elif backend == 'per_run':
+        predict_per_run(args, pred_dir, pending)
+    else:
+        raise ValueError(f"Unknown prediction backend {backend}")
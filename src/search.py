@@ -0,0 +1,58 @@
+import os
+from src.utils.helpers import *
+from src.utils.mmseqs import *
+from src.utils.msa_store import *
+from src.utils.instrument import *
+from src.utils.manifest import *
+from src.status import *
+
+def get_msa_store(args):
+    if getattr(args, 'msa_store', None) is None:
+        return None
+    store = dict_to_namespace(args.msa_store)
+    if not store.enabled:
+        return None
+    root = store.dir or os.path.join(args.tmpdir, 'msa_store')
+    return MSAStore(root, max_bytes=int(float(store.max_gb) * 2**30))
+
+def record_msa(args, id_, seq, backend):
+    subfolder = os.path.join(args.outdir, id_)
+    manifest = Manifest(subfolder)
+    path = os.path.join(subfolder, f'{id_}.a3m')
+    manifest.record('msa', msa_inputs(seq), backend, {path: manifest.fingerprint(path)})
+
+def generate_msas(args, ids, seqs):
+    ''' Search all targets whose {id}.a3m is missing or was searched for another sequence, in batches of msa_batch_size '''
+    with reporting(args, os.path.join(args.outdir, 'run_report.jsonl')), stage('generate_msas', n_targets=len(ids)):
+        api_kwargs = getattr(args, 'mmseqs_api', None) or {}
+        todo = [(id_, seq_) for id_, seq_ in zip(ids, seqs) if not msa_current(args, id_, seq_)]
+
+        store = get_msa_store(args)
+        if store is not None:
+            with stage('msa_store_get', n_targets=len(todo)) as rec:
+                backend = msa_backend(host_url=api_kwargs.get('host_url', "https://api.colabfold.com"))
+                for id_, _ in todo:
+                    os.makedirs(os.path.join(args.outdir, id_), exist_ok=True)
+                hits = {id_ for id_, seq_ in todo
+                        if store.get(store.key(seq_, backend), os.path.join(args.outdir, id_, f'{id_}.a3m'))}
+                for id_, seq_ in todo:
+                    if id_ in hits:
+                        record_msa(args, id_, seq_, backend)
+                todo = [(id_, seq_) for id_, seq_ in todo if id_ not in hits]
+                rec['n_hits'] = rec['n_targets'] - len(todo)
+
+        batch_size = getattr(args, 'msa_batch_size', None) or max(len(todo), 1)
+        for i in range(0, len(todo), batch_size):
+            batch = todo[i:i + batch_size]
+            print(f'Generating MSAs for targets {i + 1}-{i + len(batch)} of {len(todo)}...')
+            outfiles = [os.path.join(args.outdir, id_, f'{id_}.a3m') for id_, _ in batch]
+            for outfile in outfiles:
+                os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            with stage('msa_batch', targets=[id_ for id_, _ in batch]):
+                _, backend = run_mmseqs_with_backend([seq_ for _, seq_ in batch], args.tmpdir, outfiles=outfiles, **api_kwargs)
+            for id_, seq_ in batch:
+                record_msa(args, id_, seq_, backend)
+            if store is not None:
+                with stage('msa_store_put', n_targets=len(batch)):
+                    for (_, seq_), outfile in zip(batch, outfiles):
+                        store.put(store.key(seq_, backend), outfile, seq_, backend)
@@ -0,0 +1,102 @@
+import os
+import copy
+import hashlib
+from src.utils.helpers import *
+from src.utils.manifest import *
+from src.predict import *
+
+# On-disk state of a target. Only light modules are imported here, so
+# status checks (and the stages that skip on them) don't load the clustering
+# or search stacks.
+
+def msa_inputs(seq):
+    return {'sequence': hashlib.sha1(seq.encode()).hexdigest()}
+
+def msa_current(args, id_, seq):
+    ''' True if {id}.a3m exists and was searched for seq (a3ms placed there by hand have no record and are kept) '''
+    path = os.path.join(args.outdir, id_, f'{id_}.a3m')
+    if not os.path.exists(path):
+        return False
+    recorded = Manifest(os.path.join(args.outdir, id_)).recorded('msa')
+    return recorded is None or recorded['inputs'] == msa_inputs(seq)
+
+def clusters_done(subfolder):
+    ''' True once run_cluster has finished writing subfolder/clusters '''
+    return os.path.exists(os.path.join(subfolder, "clusters", ".done"))
+
+def cluster_config(args):
+    ''' The settings that determine the cluster a3ms (the manifest's cluster config) '''
+    dbscan = {k: v for k, v in (args.dbscan or {}).items() if k != 'n_jobs'}
+    config = {'keyword': args.keyword, 'gap_cutoff': args.gap_cutoff, 'random_seed': getattr(args, 'random_seed', None),
+              'cluster_method': args.cluster_method, 'cluster_bundle': getattr(args, 'cluster_bundle', False), 'dbscan': dbscan}
+    if args.cluster_method == 'dbscan_lsh':
+        config['dbscan_lsh'] = getattr(args, 'dbscan_lsh', None)
+    if (getattr(args, 'cluster_prune', None) or {}).get('enabled'):
+        config['cluster_prune'] = args.cluster_prune
+    return config
+
+def clusters_current(args, subfolder, input, manifest=None):
+    ''' True if subfolder/clusters was written from this input MSA with the current settings and is unchanged since '''
+    if not clusters_done(subfolder) or not os.path.exists(input):
+        return False
+    manifest = manifest or Manifest(subfolder)
+    return manifest.fresh('cluster', {'a3m': manifest.digest(input)}, cluster_config(args))
+
+def target_status(args, id_, seq=None):
+    ''' What is left to do for one target, from its folder and manifest alone.
+
+    msa and clusters are "done", "stale" (on disk but made for another
+    sequence, MSA or settings) or "missing"; predictions count the
+    (cluster, seed) pairs with a done file, and harvest is "done" when the
+    model table is newer than every done file. next is the first stage with
+    work left, or None.
+    '''
+    args = copy.copy(args)
+    args.keyword = id_
+    subfolder = os.path.join(args.outdir, id_)
+    msa_file = os.path.join(subfolder, f'{id_}.a3m')
+    manifest = Manifest(subfolder)
+    status = {'id': id_, 'msa': 'missing', 'clusters': 'missing', 'n_clusters': 0, 'predictions': 0, 'n_predictions': 0,
+              'harvest': 'missing'}
+
+    if os.path.exists(msa_file):
+        status['msa'] = 'done' if seq is None or msa_current(args, id_, seq) else 'stale'
+    if status['msa'] == 'done' and clusters_current(args, subfolder, msa_file, manifest):
+        status['clusters'] = 'done'
+    elif clusters_done(subfolder):
+        status['clusters'] = 'stale'
+
+    if status['clusters'] == 'done':
+        pred_dir = os.path.join(subfolder, 'preds')
+        files = cluster_files(subfolder, manifest)
+        seeds = generate_command(args, return_seeds=True)
+        recorded = manifest.recorded('predict')
+        same = recorded is not None and recorded['config'] == predict_config(args)
+        done = [done_file(pred_dir, os.path.splitext(os.path.basename(fil))[0], i) for fil in files for i in range(seeds)]
+        done = [f for f in done if os.path.exists(f)] if same else []
+        status.update(n_clusters=len(files), predictions=len(done), n_predictions=len(files) * seeds)
+
+        table = os.path.join(subfolder, f'{id_}.models.npz')
+        if os.path.exists(table) and all(os.path.getmtime(f) <= os.path.getmtime(table) for f in done):
+            status['harvest'] = 'done'
+        elif not done:
+            status['harvest'] = '-'
+
+    harvest = dict_to_namespace(getattr(args, 'harvest', None) or {'enabled': False})
+    steps = [('msa', status['msa'] == 'done'), ('cluster', status['clusters'] == 'done'),
+             ('predict', status['predictions'] == status['n_predictions']),
+             ('harvest', not harvest.enabled or status['harvest'] != 'missing')]
+    status['next'] = next((name for name, finished in steps if not finished), None)
+    return status
+
+def format_status(rows):
+    ''' A fixed-width table of target_status rows with a summary line '''
+    lines = [f"{'target':<24} {'msa':<8} {'clusters':<9} {'predictions':>13} {'harvest':<8} next"]
+    for r in rows:
+        preds = f"{r['predictions']}/{r['n_predictions']}" if r['clusters'] == 'done' else '-'
+        lines.append(f"{r['id']:<24} {r['msa']:<8} {r['clusters']:<9} {preds:>13} {r['harvest']:<8} {r['next'] or 'done'}")
+    counts = {}
+    for r in rows:
+        counts[r['next'] or 'done'] = counts.get(r['next'] or 'done', 0) + 1
+    lines.append(', '.join(f'{n} {stage}' for stage, n in counts.items()) + f" of {len(rows)} targets")
+    return '\n'.join(lines)
@@ -0,0 +1,205 @@
+import os
+import json
+import mmap
+import numpy as np
+from src.utils.seqs import ALPHABET, PAD
+
+_WHITESPACE = b' \t\r\n\x00'
+
+def _code_lut(alphabet=ALPHABET):
+    ''' byte -> residue code; anything that is not an uppercase residue or '-' maps to PAD (dropped) '''
+    A = len(alphabet)
+    lut = np.full(256, PAD, dtype=np.uint8)
+    lut[ord('A'):ord('Z') + 1] = A - 1  # unknowns -> '-'
+    for i, res in enumerate(alphabet):
+        lut[ord(res)] = i
+    return lut
+
+def map_file(path):
+    ''' Read-only memory map of path as a uint8 array (empty array for empty files) '''
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    with open(path, 'rb') as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(mm, dtype=np.uint8)
+
+def index_records(buf):
+    ''' Byte offsets of every record in a FASTA/A3M buffer.
+
+    Returns (header_starts, id_ends, seq_starts, seq_ends): the header runs from
+    header_starts (the '>') to seq_starts - 1 (its newline), the ID ends at the
+    first whitespace of the header (a CRLF's '\r' included), and the raw
+    sequence (insertions, newlines) spans seq_starts:seq_ends.
+    '''
+    newlines = np.flatnonzero(buf == ord('\n'))
+    line_starts = np.concatenate([[0], newlines + 1])
+    line_starts = line_starts[line_starts < len(buf)]
+    header_starts = line_starts[buf[line_starts] == ord('>')]
+    # len(buf) sentinels stand in for a missing final newline / headers without blanks
+    header_ends = np.append(newlines, len(buf))[np.searchsorted(newlines, header_starts)]
+    blanks = np.append(np.flatnonzero((buf == ord(' ')) | (buf == ord('\t')) | (buf == ord('\r'))), len(buf))
+    id_ends = np.minimum(blanks[np.searchsorted(blanks, header_starts)], header_ends)
+    seq_starts = np.minimum(header_ends + 1, len(buf))
+    seq_ends = np.concatenate([header_starts[1:], [len(buf)]])
+    return header_starts, id_ends, seq_starts, seq_ends
+
+def read_a3m(path, alphabet=ALPHABET):
+    ''' Parse an A3M without per-residue Python work.
+
+    Insertions (lowercase), '.', and whitespace are stripped with a byte lookup,
+    and each row's aligned columns become a row of the N x L uint8 code matrix,
+    L being the query (first row) length. Headers and insertion-bearing rows
+    stay in the memory-mapped buffer and are addressed through the offsets.
+    '''
+    buf = map_file(path)
+    header_starts, id_ends, seq_starts, seq_ends = index_records(buf)
+    N = len(header_starts)
+    if N == 0:
+        return MSA(buf, (header_starts, id_ends, seq_starts, seq_ends), np.zeros((0, 0), dtype=np.uint8), np.zeros(0, dtype=np.int64))
+
+    # mark header bytes so residues in sequence names are not picked up
+    in_header = np.zeros(len(buf) + 1, dtype=np.int8)
+    np.add.at(in_header, header_starts, 1)
+    np.add.at(in_header, seq_starts, -1)
+    in_header = np.cumsum(in_header[:-1], dtype=np.int8).astype(bool)
+
+    lut = _code_lut(alphabet)
+    aligned = (lut[buf] != PAD) & ~in_header
+    lengths = np.add.reduceat(aligned, header_starts, dtype=np.int64)
+    n_gaps = np.add.reduceat((buf == ord('-')) & aligned, header_starts, dtype=np.int64)
+
+    residues = lut[buf[aligned]]
+    L = int(lengths[0])
+    if (lengths == L).all():
+        codes = residues.reshape(N, L)
+    else:
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        row = np.repeat(np.arange(N), lengths)
+        col = np.arange(len(residues)) - np.repeat(offsets, lengths)
+        fits = col < L
+        codes = np.full((N, L), PAD, dtype=np.uint8)
+        codes[row[fits], col[fits]] = residues[fits]
+    return MSA(buf, (header_starts, id_ends, seq_starts, seq_ends), codes, n_gaps)
+
+def _compose(rows, n, key):
+    ''' Indices selected by key (slice, index array or boolean mask) from rows, None meaning range(n); slices of ranges stay ranges '''
+    rows = range(n) if rows is None else rows
+    if isinstance(key, slice):
+        return rows[key]
+    key = np.asarray(key)
+    if key.dtype == bool:
+        if key.shape != (len(rows),):
+            raise IndexError(f'boolean index of shape {key.shape} does not match {len(rows)} rows')
+        key = np.flatnonzero(key)
+    if isinstance(rows, range):
+        key = key.astype(np.int64)
+        if ((key < -len(rows)) | (key >= len(rows))).any():
+            raise IndexError(f'row index out of range for {len(rows)} rows')
+        return rows.start + key % max(len(rows), 1) * rows.step
+    return rows[key]
+
+def _take(arr, rows):
+    ''' arr[rows]: a view for ranges, a copy for index arrays '''
+    if rows is None or arr is None:
+        return arr
+    if isinstance(rows, range):
+        return arr[rows.start:rows.stop if rows.stop >= 0 else None:rows.step]
+    return arr[rows]
+
+class MSA:
+    ''' Records of an A3M/FASTA file: one byte buffer plus offset arrays, and the aligned uint8 code matrix.
+
+    buf holds the file (memory-mapped by read_a3m) and offsets the
+    header_starts, id_ends, seq_starts and seq_ends of its records (see
+    index_records), so names and insertion-bearing rows are never copied out
+    as Python strings. codes is the matching N x L matrix (and n_gaps the '-'
+    count per row); either may be None, e.g. for a plain FASTA.
+
+    Indexing with a slice, index array or boolean mask returns a view that
+    shares buf, offsets and codes and only records which rows it selects.
+    Nothing is copied until a view's codes are used, and slices stay
+    zero-copy even then, so filtering, subsampling and per-cluster selection
+    cost one index array each.
+    '''
+    def __init__(self, buf, offsets, codes=None, n_gaps=None, rows=None, code_rows=None):
+        self.buf = buf
+        self._offsets, self._rows = tuple(offsets), rows
+        self._codes, self._n_gaps, self._code_rows = codes, n_gaps, code_rows
+        self._gathered = None
+
+    def __len__(self):
+        return len(self._offsets[0]) if self._rows is None else len(self._rows)
+
+    def __getitem__(self, key):
+        codes_rows = None if self._codes is None else _compose(self._code_rows, len(self._codes), key)
+        return MSA(self.buf, self._offsets, self._codes, self._n_gaps, _compose(self._rows, len(self._offsets[0]), key), codes_rows)
+
+    @property
+    def offsets(self):
+        ''' (header_starts, id_ends, seq_starts, seq_ends) of the selected records '''
+        return tuple(_take(o, self._rows) for o in self._offsets)
+
+    @property
+    def codes(self):
+        if self._gathered is None:
+            self._gathered = _take(self._codes, self._code_rows)
+        return self._gathered
+
+    @property
+    def n_gaps(self):
+        return _take(self._n_gaps, self._code_rows)
+
+    def ids(self):
+        header_starts, id_ends, _, _ = self.offsets
+        return [self.buf[h + 1:e].tobytes() for h, e in zip(header_starts, id_ends)]
+
+    def seqs(self):
+        ''' Raw sequences (insertions kept) with line breaks removed '''
+        _, _, seq_starts, seq_ends = self.offsets
+        return [self.buf[s:e].tobytes().translate(None, _WHITESPACE) for s, e in zip(seq_starts, seq_ends)]
+
+    def format(self):
+        ''' The selected records (IDs and insertion-bearing sequences) as fasta bytes '''
+        return b''.join(b'>' + id_ + b'\n' + seq + b'\n' for id_, seq in zip(self.ids(), self.seqs()))
+
+    def write(self, outfile):
+        ''' Write the selected records as fasta in a single write '''
+        with open(outfile, 'wb') as f:
+            f.write(self.format())
+
+    def groups(self, labels, groups):
+        ''' Yield (group, view of the rows with labels == group) for every group '''
+        for group, rows in group_rows(labels, np.arange(len(self)), groups):
+            yield group, self[rows]
+
+def group_rows(labels, rows, groups):
+    ''' Yield (group, rows[labels == group]) for every group from one stable sort of labels '''
+    order = np.argsort(labels, kind='stable')
+    sorted_labels = labels[order]
+    starts = np.searchsorted(sorted_labels, groups, side='left')
+    ends = np.searchsorted(sorted_labels, groups, side='right')
+    for group, start, end in zip(groups, starts, ends):
+        yield group, rows[order[start:end]]
+
+def write_bundle(path, named_chunks):
+    ''' Concatenate (name, bytes) chunks into path and write a JSON index {name: [start, end]} to path.json '''
+    index, offset = {}, 0
+    with open(f'{path}.part', 'wb') as f:
+        for name, chunk in named_chunks:
+            f.write(chunk)
+            index[name] = [offset, offset + len(chunk)]
+            offset += len(chunk)
+    os.replace(f'{path}.part', path)
+    with open(f'{path}.json', 'w') as f:
+        json.dump(index, f)
+    return index
+
+def read_bundle(path, name=None):
+    ''' Bytes of the named chunk of a bundle written by write_bundle, or {name: bytes} for all of them '''
+    with open(f'{path}.json') as f:
+        index = json.load(f)
+    buf = map_file(path)
+    if name is not None:
+        start, end = index[name]
+        return buf[start:end].tobytes()
+    return {n: buf[start:end].tobytes() for n, (start, end) in index.items()}
@@ -0,0 +1,73 @@
+import os
+import mmap
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+def file_sha1(path, chunk=1 << 24):
+    ''' SHA1 of a file's contents '''
+    h = hashlib.sha1()
+    if os.path.getsize(path) == 0:
+        return h.hexdigest()
+    with open(path, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(0, len(mm), chunk):
+            h.update(mm[i:i + chunk])
+    return h.hexdigest()
+
+class ArrayCache:
+    ''' Directory of memory-mappable .npy bundles, one subdirectory per key, capped at max_bytes.
+
+    Entries are written to a temporary directory and renamed into place, so
+    concurrent jobs sharing the cache never see partial entries. A hit touches
+    the entry; when the cache grows past max_bytes the least recently used
+    entries are removed.
+    '''
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('\x1f'.join(str(p) for p in parts).encode()).hexdigest()
+
+    def load(self, key):
+        ''' Return {name: read-only memmap} for key, or None on a miss '''
+        path = os.path.join(self.root, key)
+        try:
+            arrays = {os.path.splitext(f)[0]: np.load(os.path.join(path, f), mmap_mode='r')
+                      for f in os.listdir(path) if f.endswith('.npy')}
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return arrays
+
+    def store(self, key, **arrays):
+        ''' Write arrays under key, evict if over budget, and return them memory-mapped '''
+        tmp = tempfile.mkdtemp(prefix=f'.{key}.', dir=self.root)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), np.ascontiguousarray(arr))
+        try:
+            os.rename(tmp, os.path.join(self.root, key))
+        except OSError:  # another job stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+        return self.load(key)
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(e.stat().st_size for e in os.scandir(path) if e.is_file())
+            entries.append((os.path.getmtime(path), size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            total -= size
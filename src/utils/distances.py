@@ -0,0 +1,92 @@
+import numpy as np
+from scipy import sparse
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from threadpoolctl import threadpool_limits
+from src.utils.seqs import ALPHABET
+from src.utils.helpers import available_cpus
+
+def _n_jobs(n_jobs):
+    if n_jobs is None or n_jobs < 1:
+        return available_cpus()
+    return int(n_jobs)
+
+def blas_limited(n_workers):
+    ''' One BLAS thread per pool worker while n_workers threads run matmuls, instead of each fanning out over every core '''
+    return threadpool_limits(1, user_api='blas') if n_workers > 1 else nullcontext()
+
+def _one_hot(codes, n_codes):
+    ''' Expand a uint8 code block to float32 one-hot; PAD (or any code >= n_codes) stays all-zero '''
+    B, L = codes.shape
+    out = np.zeros((B, L * n_codes), dtype=np.float32)
+    rows, cols = np.nonzero(codes < n_codes)
+    out[rows, cols * n_codes + codes[rows, cols]] = 1
+    return out
+
+def sq_distances(codes_a, codes_b, n_codes=len(ALPHABET)):
+    ''' Squared Euclidean distances between the one-hot encodings of two code blocks.
+
+    Equals 2 * mismatches for equal-length rows without padding, i.e. exactly
+    what DBSCAN sees on one-hot encoded sequences. Returned as int32.
+    '''
+    oh_a, oh_b = _one_hot(codes_a, n_codes), _one_hot(codes_b, n_codes)
+    n_a = (codes_a < n_codes).sum(1).astype(np.int32)
+    n_b = (codes_b < n_codes).sum(1).astype(np.int32)
+    matches = np.rint(oh_a @ oh_b.T).astype(np.int32)
+    return n_a[:, None] + n_b[None, :] - 2 * matches
+
+def _radius_block(codes, start, stop, r2, block_size, n_codes):
+    rows, cols, d2s = [], [], []
+    a = codes[start:stop]
+    for j in range(0, len(codes), block_size):
+        d2 = sq_distances(a, codes[j:j + block_size], n_codes)
+        r, c = np.nonzero(d2 <= r2)
+        rows.append(r + start)
+        cols.append(c + j)
+        d2s.append(d2[r, c])
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(d2s)
+
+def radius_neighbors_graph(codes, radius, block_size=1024, n_jobs=None, n_codes=len(ALPHABET)):
+    ''' Sparse N x N graph of Euclidean distances (one-hot semantics) between all rows within radius.
+
+    Rows are processed in blocks of block_size on n_jobs threads, so peak memory
+    is O(block_size^2 + nnz) instead of O(N * L * 21). Self-distances are stored
+    as explicit zeros, which DBSCAN(metric="precomputed") treats as neighbours.
+    '''
+    codes = np.ascontiguousarray(codes, dtype=np.uint8)
+    N = len(codes)
+    r2 = int(np.floor(radius ** 2 + 1e-9))
+    starts = range(0, N, block_size)
+    n_jobs = _n_jobs(n_jobs)
+    with blas_limited(n_jobs), ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        parts = list(pool.map(lambda s: _radius_block(codes, s, min(s + block_size, N), r2, block_size, n_codes), starts))
+    if parts:
+        rows, cols, d2 = (np.concatenate(x) for x in zip(*parts))
+    else:
+        rows, cols, d2 = (np.empty(0, dtype=np.int64),) * 3
+    return sparse.csr_matrix((np.sqrt(d2.astype(np.float64)), (rows, cols)), shape=(N, N))
+
+def _knn_block(codes, start, stop, k, weights, n_codes):
+    d2 = sq_distances(codes[start:stop], codes, n_codes)
+    order = np.argsort(d2, axis=1, kind='stable')
+    cum = np.cumsum(weights[order], axis=1)
+    reached = cum >= k
+    first = reached.argmax(1)
+    kd2 = np.take_along_axis(d2, order, axis=1)[np.arange(stop - start), first]
+    return np.where(reached.any(1), np.sqrt(kd2.astype(np.float64)), np.inf)
+
+def knn_distances(codes, k, sample_weight=None, block_size=256, n_jobs=None, n_codes=len(ALPHABET)):
+    ''' Distance from every row to its k-th nearest row (one-hot semantics), counting the row itself.
+
+    With sample_weight, row j counts sample_weight[j] times, so this is the
+    smallest eps at which the row is a DBSCAN core point for min_samples=k
+    (inf if the whole set weighs less than k). Exact, O(N^2) in blocks.
+    '''
+    codes = np.ascontiguousarray(codes, dtype=np.uint8)
+    N = len(codes)
+    weights = np.ones(N) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    starts = range(0, N, block_size)
+    n_jobs = _n_jobs(n_jobs)
+    with blas_limited(n_jobs), ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        parts = list(pool.map(lambda s: _knn_block(codes, s, min(s + block_size, N), k, weights, n_codes), starts))
+    return np.concatenate(parts) if parts else np.empty(0)
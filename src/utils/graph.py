@@ -0,0 +1,15 @@
+from src.utils.reachability import fit_reachability, count_reachability_clusters
+from src.utils.instrument import stage
+
+def sweep_eps(graph, eps_vals, min_samples, sample_weight=None, n_jobs=None):
+    ''' Cluster counts (len(set(DBSCAN(eps).labels_)), noise included) for every eps in eps_vals,
+    from one graph built at radius >= max(eps_vals).
+
+    The graph's edges are sorted once into core distances and a spanning
+    forest (see fit_reachability), after which each candidate is two binary
+    searches: no per-candidate copy of the graph, so memory does not grow with
+    the number of candidates. n_jobs is unused and kept for the sweep signature.
+    '''
+    with stage('eps_sweep', n_rows=graph.shape[0], n_edges=graph.nnz, n_candidates=len(eps_vals)) as rec:
+        rec['n_clusters'] = count_reachability_clusters(fit_reachability(graph, min_samples, sample_weight), eps_vals)
+    return rec['n_clusters']
@@ -1,6 +1,14 @@
+import os
 from argparse import Namespace
 
 def dict_to_namespace(d):
     if isinstance(d, dict):
         return Namespace(**{k: dict_to_namespace(v) for k, v in d.items()})
-    return d
\ No newline at end of file
+    return d
+
+def available_cpus():
+    ''' CPUs this process may run on (its Slurm/cgroup allocation), not every core of the node '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import cProfile
+import resource
+import threading
+import contextvars
+import tracemalloc
+from contextlib import contextmanager
+from src.utils.helpers import dict_to_namespace
+
+_report = contextvars.ContextVar('report', default=None)
+_lock = threading.Lock()
+_open_stages = 0
+_profiling = threading.local()
+
+def _reset_peak_rss():
+    ''' Restart the kernel's peak-RSS counter (VmHWM); best effort, Linux only '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _child_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class RunReport:
+    ''' Appends one JSON record per finished stage to path (JSON lines).
+
+    Records carry the base fields given here (e.g. target), the stage name,
+    wall/CPU/child-CPU seconds, peak RSS and whatever counts the stage set.
+    With profile, every outermost stage on the thread that created the report
+    is run under cProfile and dumped to {dir of path}/profile/{stage}.{n}.prof
+    (worker threads are not profiled); with trace_memory the Python heap
+    peak from tracemalloc is added to each record.
+    '''
+    def __init__(self, path, profile=False, trace_memory=False, **base):
+        self.path = path
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.base = base
+        self.owner = threading.get_ident()
+        self._n_profiles = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def write(self, record):
+        with _lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({**self.base, **record}, default=str) + '\n')
+
+    def dump_profile(self, profiler, name):
+        with _lock:
+            self._n_profiles += 1
+            n = self._n_profiles
+        profile_dir = os.path.join(os.path.dirname(os.path.abspath(self.path)), 'profile')
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f'{name}.{n}.prof'))
+
+def run_report(args, path, **base):
+    ''' RunReport writing to path as configured by args.instrument, or None when instrumentation is off '''
+    if getattr(args, 'instrument', None) is None:
+        return None
+    instrument = dict_to_namespace(args.instrument)
+    if not instrument.enabled:
+        return None
+    return RunReport(path, profile=getattr(instrument, 'profile', False),
+                     trace_memory=getattr(instrument, 'tracemalloc', False), **base)
+
+@contextmanager
+def reporting(args, path, **base):
+    ''' Route stage() records in this context (thread) to path; no-op when instrumentation is off '''
+    report = run_report(args, path, **base)
+    if report is None:
+        yield None
+        return
+    token = _report.set(report)
+    try:
+        yield report
+    finally:
+        _report.reset(token)
+
+def carry_report(fn):
+    ''' Wrap fn so it records into the caller's report when run on another thread '''
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.copy().run(fn, *a, **kw)
+
+@contextmanager
+def stage(name, **fields):
+    ''' Time the enclosed block and write it to the active report as one record.
+
+    Yields a dict the block can add counts to. Peak RSS and the tracemalloc
+    peak are process-wide: they are reset when no other stage is open, so
+    nested or concurrent stages report the peak since the outermost one began.
+    Without an active report this only yields the dict.
+    '''
+    global _open_stages
+    record = {'stage': name, **fields}
+    report = _report.get()
+    if report is None:
+        yield record
+        return
+
+    with _lock:
+        outermost = _open_stages == 0
+        _open_stages += 1
+    if outermost:
+        _reset_peak_rss()
+    if report.trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif outermost:
+            tracemalloc.reset_peak()
+    profiler = None
+    if report.profile and threading.get_ident() == report.owner and not getattr(_profiling, 'active', False):
+        profiler, _profiling.active = cProfile.Profile(), True
+        profiler.enable()
+
+    started, wall, cpu, child = time.time(), time.perf_counter(), time.process_time(), _child_cpu()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record.update(start=started, wall_s=time.perf_counter() - wall, cpu_s=time.process_time() - cpu,
+                      child_cpu_s=_child_cpu() - child, peak_rss_mb=_peak_rss_mb())
+        if report.trace_memory:
+            record['py_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        if profiler is not None:
+            profiler.disable()
+            _profiling.active = False
+            report.dump_profile(profiler, name)
+        with _lock:
+            _open_stages -= 1
+        report.write(record)
@@ -0,0 +1,98 @@
+import numpy as np
+from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.seqs import ALPHABET
+from src.utils.distances import radius_neighbors_graph, _n_jobs, blas_limited
+
+def informative_columns(codes):
+    ''' Columns where not every row carries the same code; all mismatches fall in these '''
+    return np.nonzero((codes != codes[:1]).any(0))[0]
+
+def hash_width(n_informative, radius, collide=0.5):
+    ''' Columns per hash so that two rows at exactly radius share a bucket with probability ~collide.
+
+    Rows at Euclidean (one-hot) distance r differ in r^2 / 2 columns, all of
+    them informative, so k sampled columns agree with probability (1 - m/n)^k.
+    '''
+    frac = (radius ** 2 / 2) / max(n_informative, 1)
+    if frac >= 1:
+        return 1
+    return max(1, int(np.log(collide) / np.log1p(-frac)))
+
+def pair_sq_distances(codes, i, j, n_codes=len(ALPHABET), chunk=1 << 16):
+    ''' sq_distances for the row pairs (i[k], j[k]) only '''
+    n = (codes < n_codes).sum(1).astype(np.int32)
+    out = np.empty(len(i), dtype=np.int32)
+    for s in range(0, len(i), chunk):
+        a, b = codes[i[s:s + chunk]], codes[j[s:s + chunk]]
+        matches = ((a == b) & (a < n_codes)).sum(1, dtype=np.int32)
+        out[s:s + chunk] = n[i[s:s + chunk]] + n[j[s:s + chunk]] - 2 * matches
+    return out
+
+def _bucket_pairs(keys, max_bucket):
+    ''' All within-bucket pairs (i < j positions) for buckets up to max_bucket rows, plus the larger buckets' members '''
+    order = np.argsort(keys, kind='stable')
+    _, start, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    size = np.repeat(counts, counts)
+    pos = np.arange(len(order)) - np.repeat(start, counts)
+    small = np.nonzero((size > 1) & (size <= max_bucket))[0]
+    i, j = [], []
+    d = 1
+    while len(small):
+        small = small[size[small] - pos[small] > d]
+        i.append(order[small])
+        j.append(order[small + d])
+        d += 1
+    large = [order[s:s + c] for s, c in zip(start, counts) if c > max_bucket]
+    i = np.concatenate(i) if i else np.empty(0, dtype=np.int64)
+    j = np.concatenate(j) if j else np.empty(0, dtype=np.int64)
+    return i, j, large
+
+def _lsh_table(codes, cols, r2, max_bucket, n_codes):
+    sub = np.ascontiguousarray(codes[:, cols])
+    keys = sub.view(np.dtype((np.void, sub.shape[1]))).ravel()
+    _, keys = np.unique(keys, return_inverse=True)
+    i, j, large = _bucket_pairs(keys.ravel(), max_bucket)
+    d2 = pair_sq_distances(codes, i, j, n_codes)
+    keep = d2 <= r2
+    rows, cols_, d2s = [i[keep]], [j[keep]], [d2[keep]]
+    for members in large:
+        g = radius_neighbors_graph(codes[members], np.sqrt(r2), n_jobs=1, n_codes=n_codes).tocoo()
+        upper = g.row < g.col
+        rows.append(members[g.row[upper]])
+        cols_.append(members[g.col[upper]])
+        d2s.append(np.rint(g.data[upper] ** 2).astype(np.int32))
+    return np.concatenate(rows), np.concatenate(cols_), np.concatenate(d2s)
+
+def lsh_radius_graph(codes, radius, n_tables=8, n_cols=None, max_bucket=512, rng=None, n_jobs=None, n_codes=len(ALPHABET)):
+    ''' Approximate radius_neighbors_graph via bit-sampling LSH over aligned columns.
+
+    Each of n_tables hashes rows by their residues at n_cols random informative
+    columns (default: hash_width at radius). Only rows sharing a bucket are
+    compared, exactly, so every stored distance is correct and only some
+    neighbours can be missed; a pair at radius is found with probability
+    ~1 - 0.5^n_tables. n_tables is the recall/speed knob. Buckets above
+    max_bucket rows are searched with the blockwise exact routine.
+    '''
+    codes = np.ascontiguousarray(codes, dtype=np.uint8)
+    N = len(codes)
+    rng = np.random.default_rng() if rng is None else rng
+    r2 = int(np.floor(radius ** 2 + 1e-9))
+    informative = informative_columns(codes) if N else np.empty(0, dtype=np.int64)
+    if n_cols is None:
+        n_cols = hash_width(len(informative), radius)
+    n_cols = min(int(n_cols), len(informative))
+
+    rows, cols, d2 = [np.arange(N)], [np.arange(N)], [np.zeros(N, dtype=np.int32)]
+    if n_cols > 0:
+        samples = [np.sort(rng.choice(informative, n_cols, replace=False)) for _ in range(n_tables)]
+        n_jobs = _n_jobs(n_jobs)
+        with blas_limited(n_jobs), ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for i, j, d in pool.map(lambda c: _lsh_table(codes, c, r2, max_bucket, n_codes), samples):
+                rows += [i, j]
+                cols += [j, i]
+                d2 += [d, d]
+    rows, cols, d2 = np.concatenate(rows), np.concatenate(cols), np.concatenate(d2)
+    _, first = np.unique(rows.astype(np.int64) * N + cols, return_index=True)
+    rows, cols, d2 = rows[first], cols[first], d2[first]
+    return sparse.csr_matrix((np.sqrt(d2.astype(np.float64)), (rows, cols)), shape=(N, N))
@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+
+def sha1_file(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def stage_key(inputs, config):
+    return hashlib.sha1(json.dumps({'inputs': inputs, 'config': config}, sort_keys=True, default=str).encode()).hexdigest()
+
+class Manifest:
+    ''' Per-target record of what each stage was run on: {subfolder}/manifest.json.
+
+    For every stage it keeps the input digests, the config subset that
+    determines the stage's outputs, a key over both, and the fingerprints
+    (size, mtime, sha1) of the outputs. A stage is fresh when its key matches
+    and its outputs are still on disk unchanged; files whose size and mtime
+    match a cached fingerprint are not hashed again. A stage's inputs are
+    the digests of the previous stage's outputs, so whatever an upstream
+    rerun changes makes the downstream stages stale.
+    '''
+    def __init__(self, subfolder):
+        self.subfolder = subfolder
+        self.path = os.path.join(subfolder, 'manifest.json')
+        self.stages, self.files = {}, {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.stages, self.files = saved['stages'], saved['files']
+
+    def _name(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.subfolder))
+
+    def fingerprint(self, path, data=None):
+        ''' {size, mtime_ns, sha1} of path; data, if given, is the file's content and is hashed instead of re-reading it '''
+        st = os.stat(path)
+        name = self._name(path)
+        known = self.files.get(name)
+        if data is None and known is not None and (known['size'], known['mtime_ns']) == (st.st_size, st.st_mtime_ns):
+            return known
+        digest = hashlib.sha1(data).hexdigest() if data is not None else sha1_file(path)
+        self.files[name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': digest}
+        return self.files[name]
+
+    def digest(self, path):
+        return self.fingerprint(path)['sha1']
+
+    def recorded(self, stage):
+        return self.stages.get(stage)
+
+    def outputs(self, stage):
+        ''' Paths of the stage's recorded outputs, or None if it has no record '''
+        rec = self.stages.get(stage)
+        return None if rec is None else [os.path.normpath(os.path.join(self.subfolder, name)) for name in rec['outputs']]
+
+    def fresh(self, stage, inputs, config):
+        ''' True if stage last ran on these inputs and config and its outputs are unchanged '''
+        rec = self.stages.get(stage)
+        if rec is None or rec['key'] != stage_key(inputs, config):
+            return False
+        for name, known in rec['outputs'].items():
+            path = os.path.join(self.subfolder, name)
+            if not os.path.exists(path) or self.fingerprint(path)['sha1'] != known['sha1']:
+                return False
+        return True
+
+    def record(self, stage, inputs, config, outputs):
+        ''' Record a finished stage; outputs maps paths to fingerprints (see fingerprint) '''
+        self.stages[stage] = {'key': stage_key(inputs, config), 'inputs': inputs, 'config': config,
+                              'outputs': {self._name(p): fp for p, fp in outputs.items()}}
+        self.save()
+
+    def invalidate(self, stage):
+        ''' Forget stage, e.g. before rewriting its outputs '''
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        os.makedirs(self.subfolder, exist_ok=True)
+        with open(f'{self.path}.part', 'w') as f:
+            json.dump({'stages': self.stages, 'files': self.files}, f, indent=1, sort_keys=True)
+        os.replace(f'{self.path}.part', self.path)
@@ -1,4 +1,6 @@
+import io
 import os
+import mmap
 import time
 import tqdm
 import random
@@ -10,7 +12,9 @@ import tarfile
 import tempfile
 import subprocess
 from typing import Tuple, List
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import hashlib
+from src.utils.instrument import stage, carry_report
 
 
 logger = logging.getLogger(__name__)
@@ -61,38 +65,77 @@ def _run_one_local_msa(query_fa: str, db_prefix: str, out_a3m: str, threads: int
     finally:
         shutil.rmtree(tmpd, ignore_errors=True)
 
-def _gather_a3m_blocks(a3m_path: str) -> dict:
-    """Return {header_int: [lines]} mapping like your remote parser."""
-    blocks = {}
-    if not os.path.isfile(a3m_path):
-        return blocks
-    update_M, M = True, None
-    with open(a3m_path) as fh:
-        for line in fh:
-            if not line:
-                continue
-            if "\x00" in line:
-                line = line.replace("\x00","")
-                update_M = True
-            if line.startswith(">") and update_M:
+def _index_a3m_blocks(a3m_path: str, offset: int = 0) -> dict:
+    """
+    Byte-offset index {M: [(start, end), ...]} of the \\x00-delimited per-query
+    blocks in an mmseqs2/ColabFold a3m, M being the integer query header of
+    each block (+ offset). Only offsets are held in memory.
+    """
+    index = {}
+    if not os.path.isfile(a3m_path) or os.path.getsize(a3m_path) == 0:
+        return index
+    with open(a3m_path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        while start < len(mm):
+            end = mm.find(b"\x00", start)
+            end = len(mm) if end == -1 else end
+            h = mm.find(b">", start, end)
+            if h != -1:
+                nl = mm.find(b"\n", h, end)
                 try:
-                    M = int(line[1:].strip())
+                    M = int(mm[h + 1:end if nl == -1 else nl].strip()) + offset
+                    index.setdefault(M, []).append((start, end))
                 except ValueError:
-                    M = None
-                update_M = False
-                if M is not None and M not in blocks:
-                    blocks[M] = []
-            if M is not None:
-                blocks[M].append(line)
-    return blocks
-
-def _run_mmseqs2_local(x, prefix, use_env=True, **kwargs):
+                    pass
+            start = end + 1
+    return index
+
+def _write_merged_a3m(indexes, M, out, chunk=1 << 20):
+    """Copy query M's blocks from every (a3m_path, index) in order into the binary file object out."""
+    for a3m_path, index in indexes:
+        if M not in index:
+            continue
+        with open(a3m_path, "rb") as fh:
+            for start, end in index[M]:
+                fh.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    data = fh.read(min(chunk, remaining))
+                    out.write(data)
+                    remaining -= len(data)
+
+def _emit_merged_a3ms(indexes, Ms, outfiles=None):
+    """Write each query's merged a3m to its outfile (returns the paths), or return them as strings."""
+    if outfiles is None:
+        merged = []
+        for M in Ms:
+            buf = io.BytesIO()
+            _write_merged_a3m(indexes, M, buf)
+            merged.append(buf.getvalue().decode())
+        return merged
+    for M, outfile in zip(Ms, outfiles):
+        with open(f"{outfile}.part", "wb") as out:
+            _write_merged_a3m(indexes, M, out)
+        os.replace(f"{outfile}.part", outfile)
+    return list(outfiles)
+
+def _extract_members(tar_gz_file: str, names, dest: str):
+    """Stream through the tarball once and extract only the members in names."""
+    names = set(names)
+    with tarfile.open(tar_gz_file, "r|gz") as tar:
+        for member in tar:
+            if member.name in names and member.isfile():
+                with tar.extractfile(member) as src, open(os.path.join(dest, f"{member.name}.part"), "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+                os.replace(os.path.join(dest, f"{member.name}.part"), os.path.join(dest, member.name))
+
+def _run_mmseqs2_local(x, prefix, use_env=True, outfiles=None, **kwargs):
     """
     Local implementation:
       - de-duplicate queries (preserve your >N mapping)
       - search against available DBs (UNIREf and optionally ENV)
       - concatenate A3Ms per query (UNIREf first, then ENV)
-    Returns list[str] like the remote path.
+    Returns list[str] like the remote path, or writes them to outfiles.
     """
 
     seqs = [x] if isinstance(x, str) else x
@@ -115,112 +158,120 @@ def _run_mmseqs2_local(x, prefix, use_env=True, **kwargs):
     qfa = str(work / "queries.fasta")
     _write_query_fasta(seqs_unique, N, qfa)
 
-    per_db_blocks = []
+    indexes = []
     for i, db in enumerate(dbs):
         out_a3m = str(work / f"out_{i}.a3m")
         _run_one_local_msa(qfa, db, out_a3m, threads=int(os.environ.get("MMSEQS_THREADS", "4")))
-        per_db_blocks.append(_gather_a3m_blocks(out_a3m))
+        indexes.append((out_a3m, _index_a3m_blocks(out_a3m)))
 
-    a3m_lines = []
-    for m in Ms:
-        merged = []
-        for blocks in per_db_blocks:
-            if m in blocks:
-                merged.extend(blocks[m])
-        a3m_lines.append("".join(merged) if merged else "")
-
-    return a3m_lines
+    return _emit_merged_a3ms(indexes, Ms, outfiles)
 
 def get_hash(x):
     return hashlib.sha1(x.encode()).hexdigest()
 
-def run_mmseqs2(x, prefix, use_env=True, use_filter=True,
-                filter=None, pairing_strategy="greedy",
-                host_url="https://api.colabfold.com", user_agent="") :
-    '''
-    Generate MSA by running MMSeqs-2 via API
-    '''
-    
-    submission_endpoint = "ticket/msa"
-    headers = {}
+def _backoff(attempt, base=1.0, cap=60.0):
+    ''' Capped exponential backoff with full jitter '''
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def _api_session(pool_size, user_agent=""):
+    ''' Shared keep-alive session sized for pool_size concurrent tickets '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     if user_agent != "":
-        headers['User-Agent'] = user_agent
-    #else:
-    #    logger.warning("No user agent specified. Please set a user agent (e.g., 'toolname/version contact@email') to help us debug in case of problems. This warning will become an error in the future.")
+        session.headers['User-Agent'] = user_agent
+    return session
 
-    def submit(seqs, mode, N=101):
-        nx = N
-        query = ""
-        for seq in seqs:
-            query += f'>{nx}\n{seq}\n'
-            nx += 1
+def _api_request(session, method, url, max_retries=5, timeout=6.02, **kwargs):
+    ''' HTTP request retried on timeouts/connection errors with backoff; raises after max_retries failures '''
+    error_count = 0
+    while True:
+        try:
+            res = session.request(method, url, timeout=timeout, **kwargs)
+            res.raise_for_status()
+            return res
+        except requests.exceptions.RequestException as e:
+            error_count += 1
+            if error_count > max_retries:
+                raise
+            sleep_time = _backoff(error_count)
+            logger.warning(f"Error while contacting MSA server ({e}). Retrying in {sleep_time:.1f}s... ({error_count}/{max_retries})")
+            time.sleep(sleep_time)
+
+def _api_json(res):
+    try:
+        return res.json()
+    except ValueError:
+        logger.error(f"Server didn't reply with json: {res.text}")
+        return {"status": "ERROR"}
+
+def _run_ticket(session, host_url, seqs, mode, path, N=101, poll_base=2.0, poll_cap=30.0, max_retries=5):
+    ''' Submit one ticket, poll until it finishes and stream its result to {path}/out.tar.gz '''
+    tar_gz_file = f'{path}/out.tar.gz'
+    if os.path.isfile(tar_gz_file):
+        return tar_gz_file
+    query = "".join(f'>{N + i}\n{seq}\n' for i, seq in enumerate(seqs))
 
+    with stage('api_ticket', n_seqs=len(seqs)) as rec:
+        rec.update(submit_s=0.0, queue_s=0.0, download_s=0.0, n_submits=0, n_polls=0)
         while True:
-            error_count = 0
-            try:
-                res = requests.post(f'{host_url}/{submission_endpoint}', data={'q': query, 'mode': mode}, timeout=6.02, headers=headers)
-            except requests.exceptions.Timeout:
-                logger.warning("Timeout while submitting to MSA server. Retrying...")
-                continue
-            except Exception as e:
-                error_count += 1
-                logger.warning(f"Error while fetching result from MSA server. Retrying... ({error_count}/5)")
-                logger.warning(f"Error: {e}")
-                time.sleep(5)
-                if error_count > 5:
-                    raise
-                continue
-            break
+            # Resubmit job until it goes through, backing off harder on RATELIMIT
+            attempt, t = 0, time.perf_counter()
+            out = _api_json(_api_request(session, "POST", f'{host_url}/ticket/msa', max_retries, data={'q': query, 'mode': mode}))
+            rec['n_submits'] += 1
+            while out["status"] in ["UNKNOWN", "RATELIMIT"]:
+                attempt += 1
+                sleep_time = _backoff(attempt, base=5.0, cap=120.0)
+                logger.warning(f"Sleeping for {sleep_time:.1f}s. Reason: {out['status']}")
+                time.sleep(sleep_time)
+                out = _api_json(_api_request(session, "POST", f'{host_url}/ticket/msa', max_retries, data={'q': query, 'mode': mode}))
+                rec['n_submits'] += 1
+            rec['submit_s'] += time.perf_counter() - t
+
+            if out["status"] == "ERROR":
+                raise Exception(f'MMseqs2 API is giving errors. Please confirm your input is a valid protein sequence. If error persists, please try again an hour later.')
+
+            if out["status"] == "MAINTENANCE":
+                raise Exception(f'MMseqs2 API is undergoing maintenance. Please try again in a few minutes.')
+
+            # wait for job to finish
+            ID, attempt, t = out["id"], 0, time.perf_counter()
+            while out["status"] in ["UNKNOWN", "RUNNING", "PENDING"]:
+                time.sleep(poll_base + _backoff(attempt, base=poll_base, cap=poll_cap))
+                attempt += 1
+                out = _api_json(_api_request(session, "GET", f'{host_url}/ticket/{ID}', max_retries))
+            rec['n_polls'] += attempt
+            rec['queue_s'] += time.perf_counter() - t
+            if out["status"] == "COMPLETE":
+                break
+            if out["status"] == "ERROR":
+                raise Exception(f'MMseqs2 API is giving errors. Please confirm your input is a valid protein sequence. If error persists, please try again an hour later.')
+
+        # Download results straight to disk
+        t = time.perf_counter()
+        with _api_request(session, "GET", f'{host_url}/result/download/{ID}', max_retries, stream=True) as res:
+            with open(f'{tar_gz_file}.part', "wb") as out:
+                for chunk in res.iter_content(chunk_size=1 << 20):
+                    out.write(chunk)
+        os.replace(f'{tar_gz_file}.part', tar_gz_file)
+        rec.update(download_s=time.perf_counter() - t, bytes=os.path.getsize(tar_gz_file))
+    return tar_gz_file
 
-        try:
-            out = res.json()
-        except ValueError:
-            logger.error(f"Server didn't reply with json: {res.text}")
-            out = {"status": "ERROR"}
-        return out
+def run_mmseqs2(x, prefix, use_env=True, use_filter=True,
+                filter=None, pairing_strategy="greedy",
+                host_url="https://api.colabfold.com", user_agent="",
+                ticket_size=10, max_in_flight=4, poll_base=2.0, poll_cap=30.0, max_retries=5,
+                outfiles=None) :
+    '''
+    Generate MSA by running MMSeqs-2 via API
 
-    def status(ID):
-        while True:
-            error_count = 0
-            try:
-                res = requests.get(f'{host_url}/ticket/{ID}', timeout=6.02, headers=headers)
-            except requests.exceptions.Timeout:
-                logger.warning("Timeout while fetching status from MSA server. Retrying...")
-                continue
-            except Exception as e:
-                error_count += 1
-                logger.warning(f"Error while fetching result from MSA server. Retrying... ({error_count}/5)")
-                logger.warning(f"Error: {e}")
-                time.sleep(5)
-                if error_count > 5:
-                    raise
-                continue
-            break
-        try:
-            out = res.json()
-        except ValueError:
-            logger.error(f"Server didn't reply with json: {res.text}")
-            out = {"status": "ERROR"}
-        return out
-
-    def download(ID, path):
-        error_count = 0
-        while True:
-            try:
-                res = requests.get(f'{host_url}/result/download/{ID}', timeout=6.02, headers=headers)
-            except requests.exceptions.Timeout:
-                logger.warning("Timeout while fetching result from MSA server. Retrying...")
-                continue
-            except Exception as e:
-                error_count += 1
-                logger.warning(f"Error while fetching result from MSA server. Retrying... ({error_count}/5)")
-                logger.warning(f"Error: {e}")
-                time.sleep(5)
-                if error_count > 5:
-                    raise
-                continue
-            break
-        with open(path, "wb") as out: out.write(res.content)
+    Unique queries are split into tickets of ticket_size sequences; up to
+    max_in_flight tickets are submitted, polled and downloaded concurrently
+    over one pooled session. Only the a3m members are pulled out of each
+    result tarball; with outfiles, each query's merged a3m is copied straight
+    from those files to outfiles[i] instead of being returned as a string.
+    '''
 
     # process input x
     seqs = [x] if isinstance(x, str) else x
@@ -238,104 +289,99 @@ def run_mmseqs2(x, prefix, use_env=True, use_filter=True,
     path = f"{prefix}_{mode}"
     if not os.path.isdir(path): os.mkdir(path)
 
-    tar_gz_file = f'{path}/out.tar.gz'
-    N, REDO = 101, True
-
+    N = 101
     seqs_unique = []
 
     [seqs_unique.append(x) for x in seqs if x not in seqs_unique]
-    Ms = [N + seqs_unique.index(seq) for seq in seqs]
 
-    if not os.path.isfile(tar_gz_file):
-        TIME_ESTIMATE = 150 * len(seqs_unique)
-        with tqdm.tqdm(total=TIME_ESTIMATE) as pbar:
-            while REDO:
-                pbar.set_description("SUBMIT")
-
-                # Resubmit job until it goes through
-                out = submit(seqs_unique, mode, N)
-                while out["status"] in ["UNKNOWN", "RATELIMIT"]:
-                    sleep_time = 5 + random.randint(0, 5)
-                    logger.error(f"Sleeping for {sleep_time}s. Reason: {out['status']}")
-                    # resubmit
-                    time.sleep(sleep_time)
-                    out = submit(seqs_unique, mode, N)
-
-                if out["status"] == "ERROR":
-                    raise Exception(f'MMseqs2 API is giving errors. Please confirm your input is a valid protein sequence. If error persists, please try again an hour later.')
-
-                if out["status"] == "MAINTENANCE":
-                    raise Exception(f'MMseqs2 API is undergoing maintenance. Please try again in a few minutes.')
-
-                # wait for job to finish
-                ID, TIME = out["id"], 0
-                pbar.set_description(out["status"])
-                while out["status"] in ["UNKNOWN", "RUNNING", "PENDING"]:
-                    t = 5 + random.randint(0, 2)
-                    logger.error(f"Sleeping for {t}s. Reason: {out['status']}")
-                    time.sleep(t)
-                    out = status(ID)
-                    pbar.set_description(out["status"])
-                    if out["status"] == "RUNNING":
-                        TIME += t
-                        pbar.update(n=t)
-                if out["status"] == "COMPLETE":
-                    if TIME < TIME_ESTIMATE:
-                        pbar.update(n=(TIME_ESTIMATE-TIME))
-                    REDO = False
-                if out["status"] == "ERROR":
-                    REDO = False
-                    raise Exception(f'MMseqs2 API is giving errors. Please confirm your input is a valid protein sequence. If error persists, please try again an hour later.')
-
-            # Download results
-            download(ID, tar_gz_file)
-
-    a3m_files = [f"{path}/uniref.a3m"]
-    if use_env: a3m_files.append(f"{path}/bfd.mgnify30.metaeuk30.smag30.a3m")
-
-    # extract a3m files
-    if any(not os.path.isfile(a3m_file) for a3m_file in a3m_files):
-        with tarfile.open(tar_gz_file) as tar_gz:
-            tar_gz.extractall(path)
-
-    
-    # gather a3m lines
-    a3m_lines = {}
-    for a3m_file in a3m_files:
-        update_M, M = True, None
-        for line in open(a3m_file, "r"):
-            if len(line) > 0:
-                if "\x00" in line:
-                    line = line.replace("\x00", "")
-                    update_M = True
-                if line.startswith(">") and update_M:
-                    M = int(line[1:].rstrip())
-                    update_M = False
-                    if M not in a3m_lines: a3m_lines[M] = []
-                a3m_lines[M].append(line)
-
-    a3m_lines = ["".join(a3m_lines[n]) for n in Ms]
-
-    return a3m_lines
+    ticket_size = ticket_size or len(seqs_unique)
+    tickets = [seqs_unique[i:i + ticket_size] for i in range(0, len(seqs_unique), ticket_size)]
+    # named by their own queries, so a different ticket_size never reuses another ticket's results
+    ticket_paths = [os.path.join(path, f"ticket_{get_hash(chr(10).join(ticket))}") for ticket in tickets]
+    for ticket_path in ticket_paths:
+        os.makedirs(ticket_path, exist_ok=True)
+
+    session = _api_session(max_in_flight, user_agent)
+    with tqdm.tqdm(total=len(tickets), desc="MSA tickets") as pbar:
+        with ThreadPoolExecutor(max_workers=max(max_in_flight, 1)) as pool:
+            futures = [pool.submit(carry_report(_run_ticket), session, host_url, ticket, mode, ticket_path, N,
+                                   poll_base, poll_cap, max_retries)
+                       for ticket, ticket_path in zip(tickets, ticket_paths)]
+            for future in as_completed(futures):
+                future.result()
+                pbar.update(1)
+
+    indexes = []
+    with stage('api_extract', n_tickets=len(tickets)):
+        for k, ticket_path in enumerate(ticket_paths):
+            a3m_names = ["uniref.a3m"]
+            if use_env: a3m_names.append("bfd.mgnify30.metaeuk30.smag30.a3m")
+
+            # extract a3m files
+            if any(not os.path.isfile(f"{ticket_path}/{name}") for name in a3m_names):
+                _extract_members(f'{ticket_path}/out.tar.gz', a3m_names, ticket_path)
+
+            # index a3m blocks, renumbering ticket-local M to the global unique index
+            for name in a3m_names:
+                indexes.append((f"{ticket_path}/{name}", _index_a3m_blocks(f"{ticket_path}/{name}", offset=k * ticket_size)))
 
+    Ms = [N + seqs_unique.index(seq) for seq in seqs]
+    with stage('msa_merge', n_queries=len(seqs)):
+        return _emit_merged_a3ms(indexes, Ms, outfiles)
 
-def run_mmseqs(seq, temp_dir='./tmp', use_env=True, use_filter=True, filter=None,
-               host_url="https://api.colabfold.com"):
+
+def msa_backend(use_env=True, use_filter=True, host_url="https://api.colabfold.com", local=None):
+    '''
+    Description of the search backend (local mmseqs2 DBs or API host) and
+    options that determine an MSA; used to key cached results.
+    '''
+    if local is None:
+        local = _have_local_mmseqs()
+    if local:
+        return {"backend": "local", "dbs": _db_prefixes(use_env), "use_env": use_env, "use_filter": use_filter}
+    return {"backend": "api", "host_url": host_url, "use_env": use_env, "use_filter": use_filter}
+
+def run_mmseqs_with_backend(seq, temp_dir='./tmp', use_env=True, use_filter=True, filter=None,
+                            host_url="https://api.colabfold.com", outfiles=None, **api_kwargs):
+    '''
+    run_mmseqs that also returns the msa_backend description of the backend
+    that actually produced the MSAs (after any local -> API fallback).
+    '''
 
     def get_hash(x):
         return hashlib.sha1(x.encode()).hexdigest()
 
-    prefix = get_hash(seq)
+    prefix = get_hash(seq if isinstance(seq, str) else "\n".join(seq))
     prefix = os.path.join(temp_dir, prefix)
-    
+
+    if filter is not None:
+        use_filter = filter
+
+    n_queries = 1 if isinstance(seq, str) else len(seq)
     if _have_local_mmseqs():
         try:
-            return _run_mmseqs2_local(seq, prefix, use_env=use_env)
+            with stage('msa_search', backend='local', n_queries=n_queries):
+                return (_run_mmseqs2_local(seq, prefix, use_env=use_env, outfiles=outfiles),
+                        msa_backend(use_env, use_filter, host_url, local=True))
         except Exception as e:
             logger.warning(f"Local mmseqs2 failed ({e}); falling back to ColabFold API.")
 
-    return run_mmseqs2(seq, prefix, 
-                        use_env=use_env, 
-                        use_filter=use_filter, 
-                        filter=filter,   
-                        host_url=host_url)
+    with stage('msa_search', backend='api', n_queries=n_queries):
+        return (run_mmseqs2(seq, prefix,
+                            use_env=use_env,
+                            use_filter=use_filter,
+                            host_url=host_url,
+                            outfiles=outfiles,
+                            **api_kwargs),
+                msa_backend(use_env, use_filter, host_url, local=False))
+
+def run_mmseqs(seq, temp_dir='./tmp', use_env=True, use_filter=True, filter=None,
+               host_url="https://api.colabfold.com", outfiles=None, **api_kwargs):
+    '''
+    Generate MSAs for one sequence or a list of sequences in a single search.
+    Returns one a3m string per input sequence, in input order, or writes them
+    to outfiles and returns the paths. api_kwargs (ticket_size,
+    max_in_flight, ...) are passed to run_mmseqs2.
+    '''
+    return run_mmseqs_with_backend(seq, temp_dir, use_env=use_env, use_filter=use_filter, filter=filter,
+                                   host_url=host_url, outfiles=outfiles, **api_kwargs)[0]
@@ -1,11 +1,15 @@
-from Bio import SeqIO
+import os
+import numpy as np
+from src.utils.a3m import *
+from src.utils.cache import *
+from src.utils.instrument import stage
 
 def load_fasta(fil):
     ''' Read a fasta file and return ids, seqs'''
-    IDs, seqs = [], []
-    for record in SeqIO.parse(fil, "fasta"):
-        IDs.append(record.id)
-        seqs.append(str(record.seq))
+    buf = map_file(fil)
+    msa = MSA(buf, index_records(buf))
+    IDs = [id_.decode() for id_ in msa.ids()]
+    seqs = [seq.translate(None, b' \t\r\n').decode() for seq in msa.seqs()]
     return IDs, seqs
 
 def write_fasta(names, seqs, outfile):
@@ -14,5 +18,37 @@ def write_fasta(names, seqs, outfile):
         for name, seq in zip(names, seqs):
             f.write(f">{name}\n{seq}\n")
 
-def clean_seqs(seqs):
-    return [''.join([x for x in s if x.isupper() or x == '-']) for s in seqs]
+def load_filtered_a3m(path, gap_cutoff, cache=None):
+    ''' Parse path and keep non-query rows with gap fraction < gap_cutoff.
+
+    Returns (query, msa): views of the query record and of the kept rows of
+    one MSA (see MSA), msa carrying their uint8 code matrix. With an
+    ArrayCache the filtered matrix and record offsets are memoized by the
+    file's SHA1 and gap_cutoff, and later calls only map the a3m for writing
+    and load the matrix zero-copy.
+    '''
+    key = None
+    if cache is not None:
+        with stage('cache_load') as rec:
+            key = cache.key(file_sha1(path), float(gap_cutoff))
+            entry = cache.load(key)
+            rec['hit'] = entry is not None
+            if entry is not None:
+                buf = map_file(path)
+                rec.update(n_kept=len(entry['rows']), n_cols=entry['codes'].shape[1])
+                return MSA(buf, entry['offsets'])[:1], MSA(buf, entry['offsets'], entry['codes'], rows=entry['rows'])
+
+    with stage('parse_encode', bytes=os.path.getsize(path)) as rec:
+        a3m = read_a3m(path)
+        rec.update(n_records=len(a3m), n_cols=a3m.codes.shape[1])
+    with stage('gap_filter', gap_cutoff=float(gap_cutoff)) as rec:
+        L = a3m.codes.shape[1]
+        rows = np.arange(1, len(a3m))
+        rows = rows[a3m.n_gaps[1:] / L < float(gap_cutoff)]
+        msa = a3m[rows]
+        rec['n_kept'] = len(rows)
+    if cache is not None:
+        with stage('cache_store'):
+            entry = cache.store(key, rows=rows, codes=msa.codes, offsets=np.stack(a3m.offsets))
+            msa = MSA(a3m.buf, a3m.offsets, entry['codes'], rows=entry['rows'])
+    return a3m[:1], msa
@@ -0,0 +1,99 @@
+import os
+import gzip
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+class MSAStore:
+    ''' Content-addressed MSA cache shared across jobs and output folders.
+
+    Each MSA is a gzip blob under {root}/blobs, addressed by a key over the
+    query sequence hash and the backend description (local/API, DB prefixes,
+    use_env/use_filter). An SQLite index records size and last use. All
+    index and blob mutations happen under an exclusive flock on {root}/.lock,
+    so concurrent Slurm jobs can share one root; least recently used entries
+    are evicted once the blobs exceed max_bytes.
+    '''
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, 'blobs'), exist_ok=True)
+        with self._locked() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS msas (
+                key TEXT PRIMARY KEY, seq_hash TEXT, backend TEXT,
+                size INTEGER, created REAL, last_used REAL)''')
+
+    @staticmethod
+    def key(seq, backend):
+        ''' Key for seq searched with backend (a msa_backend() description) '''
+        seq_hash = hashlib.sha1(seq.encode()).hexdigest()
+        return hashlib.sha1(json.dumps({'seq': seq_hash, **backend}, sort_keys=True).encode()).hexdigest()
+
+    def _blob(self, key):
+        return os.path.join(self.root, 'blobs', key[:2], f'{key}.a3m.gz')
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.root, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            db = sqlite3.connect(os.path.join(self.root, 'index.sqlite'), timeout=60)
+            try:
+                with db:
+                    yield db
+            finally:
+                db.close()
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, key, dest):
+        ''' Decompress the MSA for key to dest; returns False on a miss '''
+        with self._locked() as db:
+            if db.execute('SELECT 1 FROM msas WHERE key = ?', (key,)).fetchone() is None:
+                return False
+            try:
+                with gzip.open(self._blob(key), 'rb') as src, open(f'{dest}.part', 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            except FileNotFoundError:
+                db.execute('DELETE FROM msas WHERE key = ?', (key,))
+                return False
+            os.replace(f'{dest}.part', dest)
+            db.execute('UPDATE msas SET last_used = ? WHERE key = ?', (time.time(), key))
+        return True
+
+    def size(self, key):
+        ''' Compressed size in bytes of the MSA for key, or None on a miss (does not touch last use) '''
+        with self._locked() as db:
+            row = db.execute('SELECT size FROM msas WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, src, seq, backend):
+        ''' Compress the a3m at src into the store under key, then evict down to max_bytes '''
+        os.makedirs(os.path.dirname(self._blob(key)), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self._blob(key)), suffix='.part')
+        with open(src, 'rb') as fin, os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+        with self._locked() as db:
+            os.replace(tmp, self._blob(key))
+            now = time.time()
+            db.execute('INSERT OR REPLACE INTO msas VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, hashlib.sha1(seq.encode()).hexdigest(), json.dumps(backend, sort_keys=True),
+                        os.path.getsize(self._blob(key)), now, now))
+            self._evict(db, keep=key)
+
+    def _evict(self, db, keep=None):
+        total = db.execute('SELECT COALESCE(SUM(size), 0) FROM msas').fetchone()[0]
+        for key, size in db.execute('SELECT key, size FROM msas ORDER BY last_used').fetchall():
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            try:
+                os.remove(self._blob(key))
+            except FileNotFoundError:
+                pass
+            db.execute('DELETE FROM msas WHERE key = ?', (key,))
+            total -= size
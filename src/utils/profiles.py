@@ -0,0 +1,50 @@
+import numpy as np
+from scipy import sparse
+from src.utils.seqs import ALPHABET
+from src.utils.a3m import group_rows
+
+GAP = len(ALPHABET) - 1
+
+def cluster_profiles(codes, labels, clusters, sample_weight=None, block_size=4096):
+    ''' Weighted residue frequencies per cluster, column and residue (K x L x A float32); PAD counts as a gap '''
+    A = len(ALPHABET)
+    N, L = codes.shape
+    w = np.ones(N) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    profiles = np.zeros((len(clusters), L * A), dtype=np.float64)
+    offsets = np.arange(L, dtype=np.int64) * A
+    for k, (_, rows) in enumerate(group_rows(labels, np.arange(N), clusters)):
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            idx = np.minimum(codes[block], GAP).astype(np.int64) + offsets
+            profiles[k] += np.bincount(idx.ravel(), weights=np.repeat(w[block], L), minlength=L * A)
+    profiles = profiles.reshape(len(clusters), L, A)
+    return (profiles / np.maximum(profiles.sum(axis=2, keepdims=True), 1e-12)).astype(np.float32)
+
+def profile_entropy(profiles):
+    ''' Mean per-column Shannon entropy (nats) of each cluster profile: a diversity score '''
+    p = np.clip(profiles, 1e-12, 1)
+    return -(profiles * np.log(p)).sum(axis=2).mean(axis=1)
+
+def consensus_identity(consensus):
+    ''' Pairwise identity of consensus sequences (K x L codes): matches over columns where either is not a gap '''
+    K, L = consensus.shape
+    ungapped = consensus != GAP
+    rows, cols = np.nonzero(ungapped)
+    onehot = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols * GAP + consensus[rows, cols])),
+                               shape=(K, L * GAP))
+    matches = (onehot @ onehot.T).toarray()
+    G = ungapped.astype(np.float32)
+    covered = G.sum(axis=1)[:, None] + G.sum(axis=1)[None, :] - G @ G.T
+    return matches / np.maximum(covered, 1)
+
+def redundant_clusters(consensus, order, identity):
+    ''' Greedy pass in order: {cluster index: (earlier kept cluster it is redundant with, their identity)} '''
+    ident = consensus_identity(consensus)
+    kept, redundant = [], {}
+    for k in order:
+        best = int(np.argmax(ident[k, kept])) if kept else -1
+        if best >= 0 and ident[k, kept[best]] >= identity:
+            redundant[k] = (kept[best], round(float(ident[k, kept[best]]), 4))
+        else:
+            kept.append(k)
+    return redundant
@@ -0,0 +1,146 @@
+import numpy as np
+from collections import namedtuple
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.seqs import ALPHABET
+from src.utils.distances import sq_distances, knn_distances, blas_limited, _n_jobs
+from src.utils.instrument import stage
+
+# core: per-row core distance (inf if never core within the graph's radius)
+# attach: per-row distance at which the row first joins a cluster, as core or border point
+# mst_*: minimum spanning forest of the mutual-reachability graph, edges sorted by weight
+Reachability = namedtuple('Reachability', ['core', 'attach', 'mst_rows', 'mst_cols', 'mst_w'])
+
+def core_distances(graph, min_samples, sample_weight=None):
+    ''' Smallest radius at which each row's (weighted, self-inclusive) neighbourhood reaches min_samples '''
+    N = graph.shape[0]
+    w = np.ones(N) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    rows = np.repeat(np.arange(N), np.diff(graph.indptr))
+    order = np.lexsort((graph.data, rows))
+    rows, d, cum = rows[order], graph.data[order], np.cumsum(w[graph.indices[order]])
+    start = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=N))[:-1]])
+    cum = cum - np.concatenate([[0], cum])[start][rows]  # restart the running sum on every row
+    core = np.full(N, np.inf)
+    reached = np.nonzero(cum >= min_samples)[0]
+    first = np.unique(rows[reached], return_index=True)
+    core[first[0]] = d[reached[first[1]]]
+    return core
+
+def fit_reachability(graph, min_samples, sample_weight=None):
+    ''' One pass over a radius graph from which DBSCAN at every eps <= radius can be read off.
+
+    Two rows are density-connected at eps iff their mutual reachability
+    max(core_p, core_q, d(p, q)) <= eps, so the core-core components at eps
+    are those of the minimum spanning forest cut at eps (as in OPTICS/HDBSCAN).
+    '''
+    graph = graph.tocsr()
+    N = graph.shape[0]
+    core = core_distances(graph, min_samples, sample_weight)
+    rows = np.repeat(np.arange(N), np.diff(graph.indptr))
+    mreach = np.maximum(np.maximum(core[rows], core[graph.indices]), graph.data)
+    keep = np.isfinite(mreach) & (rows != graph.indices)
+    # shift by 1 so zero-weight edges survive; a constant shift does not change the spanning forest
+    mr = sparse.csr_matrix((mreach[keep] + 1, (rows[keep], graph.indices[keep])), shape=(N, N))
+    mst = minimum_spanning_tree(mr).tocoo()
+    # recompute the forest's weights from the graph rather than undoing the shift in floating point
+    mst_w = np.maximum(np.maximum(core[mst.row], core[mst.col]), np.asarray(graph[mst.row, mst.col]).ravel())
+    order = np.argsort(mst_w, kind='stable')
+    # a row joins a cluster once it is core itself or within eps of a core row
+    via = np.maximum(core[graph.indices], graph.data)
+    attach = core.copy()
+    if len(via):
+        np.minimum.at(attach, rows, via)
+    return Reachability(core, attach, mst.row[order], mst.col[order], mst_w[order])
+
+def _forest_block(codes, start, stop, core2, n_codes, block_size=1024):
+    ''' Spanning forest of the mutual-reachability edges out of rows start:stop (squared weights), and their squared attach distances '''
+    N = len(codes)
+    d2 = [sq_distances(codes[start:stop], codes[j:j + block_size], n_codes) for j in range(0, N, block_size)]
+    m2 = np.maximum(np.concatenate(d2, axis=1), core2[None, :])
+    attach2 = m2.min(1)
+    np.maximum(m2, core2[start:stop, None], out=m2)
+    m2[np.arange(stop - start), np.arange(start, stop)] = np.inf
+    rows, cols = np.nonzero(np.isfinite(m2))
+    # squared distances are integers: shifted by 1 they stay exact and zero distances survive as edges
+    mst = minimum_spanning_tree(sparse.csr_matrix((m2[rows, cols] + 1, (rows + start, cols)), shape=(N, N))).tocoo()
+    return mst.row, mst.col, mst.data - 1, attach2
+
+def fit_reachability_full(codes, min_samples, sample_weight=None, n_jobs=None, block_edges=1 << 21, n_codes=len(ALPHABET)):
+    ''' fit_reachability over the complete graph of all rows, valid for every eps, without building the graph.
+
+    Core distances come from one knn_distances pass; a second pass computes
+    each row block's distances, reduces them to the block's spanning forest
+    and attach distances, and merges the forests (an edge left out of a
+    subgraph's spanning forest is never in the whole graph's). Peak memory is
+    O(n_jobs * block_edges + N) however dense the graph would be.
+    '''
+    codes = np.ascontiguousarray(codes, dtype=np.uint8)
+    N = len(codes)
+    core = knn_distances(codes, min_samples, sample_weight, n_jobs=n_jobs, n_codes=n_codes)
+    core2 = np.rint(core ** 2)
+    block = max(1, block_edges // max(N, 1))
+    n_jobs = _n_jobs(n_jobs)
+    attach2 = np.empty(N)
+    forest, pending = (np.empty(0, dtype=np.int64),) * 2 + (np.empty(0),), []
+
+    def merge(parts):
+        rows, cols, w = (np.concatenate(x) for x in zip(forest, *parts))
+        mst = minimum_spanning_tree(sparse.csr_matrix((w + 1, (rows, cols)), shape=(N, N))).tocoo()
+        return mst.row.astype(np.int64), mst.col.astype(np.int64), mst.data - 1
+
+    starts = range(0, N, block)
+    with blas_limited(n_jobs), ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        # n_jobs blocks at a time, so finished block forests don't pile up ahead of the merge
+        for i in range(0, len(starts), n_jobs):
+            wave = starts[i:i + n_jobs]
+            for start, (rows, cols, w, att) in zip(wave, pool.map(lambda s: _forest_block(codes, s, min(s + block, N), core2, n_codes), wave)):
+                attach2[start:start + len(att)] = att
+                pending.append((rows, cols, w))
+            if sum(len(p[0]) for p in pending) >= block_edges:
+                forest, pending = merge(pending), []
+    forest = merge(pending)
+    order = np.argsort(forest[2], kind='stable')
+    return Reachability(core, np.sqrt(attach2), forest[0][order], forest[1][order], np.sqrt(forest[2][order]))
+
+def count_reachability_clusters(reach, eps_vals):
+    ''' len(set(DBSCAN(eps).labels_)) for every eps, noise included: #core rows - #forest edges (+1 if noise) '''
+    eps_vals = np.asarray(eps_vals, dtype=np.float64)
+    n_core = np.searchsorted(np.sort(reach.core), eps_vals, side='right')
+    n_edges = np.searchsorted(reach.mst_w, eps_vals, side='right')
+    noise = reach.attach.max(initial=-np.inf) > eps_vals
+    return (n_core - n_edges + noise).tolist()
+
+def sweep_reachability(graph, eps_vals, min_samples, sample_weight=None, n_jobs=None):
+    ''' Drop-in for sweep_eps: a single reachability fit instead of one component search per eps '''
+    with stage('reachability_sweep', n_rows=graph.shape[0], n_candidates=len(eps_vals)) as rec:
+        rec['n_clusters'] = count_reachability_clusters(fit_reachability(graph, min_samples, sample_weight), eps_vals)
+    return rec['n_clusters']
+
+def reachability_labels(reach, graph, eps):
+    ''' DBSCAN labels at eps, numbered as sklearn does.
+
+    Clusters are numbered by their lowest-index core row; a border row takes
+    the lowest label among the clusters of its core neighbours within eps.
+    '''
+    graph = graph.tocsr()
+    N = graph.shape[0]
+    is_core = reach.core <= eps
+    cut = reach.mst_w <= eps
+    forest = sparse.csr_matrix((np.ones(cut.sum()), (reach.mst_rows[cut], reach.mst_cols[cut])), shape=(N, N))
+    _, comp = connected_components(forest, directed=False)
+    labels = np.full(N, -1, dtype=np.int64)
+    core_idx = np.nonzero(is_core)[0]
+    _, first, inverse = np.unique(comp[core_idx], return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+    labels[core_idx] = rank[inverse.ravel()]
+
+    rows = np.repeat(np.arange(N), np.diff(graph.indptr))
+    border = ~is_core[rows] & is_core[graph.indices] & (graph.data <= eps)
+    if border.any():
+        best = np.full(N, np.iinfo(np.int64).max)
+        np.minimum.at(best, rows[border], labels[graph.indices[border]])
+        hit = best < np.iinfo(np.int64).max
+        labels[hit] = best[hit]
+    return labels
@@ -1,13 +1,15 @@
 import numpy as np
 
-def encode_seqs(seqs, max_len=108, alphabet=None):
-    if alphabet is None:
-        alphabet = "ACDEFGHIKLMNPQRSTVWY-"
-    A = len(alphabet)
-    lookup = {res: i for i, res in enumerate(alphabet)}
+ALPHABET = "ACDEFGHIKLMNPQRSTVWY-"
+PAD = 255
 
-    arr = np.zeros((len(seqs), max_len, A), dtype=np.float32)
-    for j, seq in enumerate(seqs):
-        idxs = [lookup.get(c, A-1) for c in seq[:max_len]]  # unknowns -> '-'
-        arr[j, np.arange(len(idxs)), idxs] = 1
-    return arr.reshape(len(seqs), max_len * A)
\ No newline at end of file
+def collapse_duplicates(codes):
+    ''' Hash the rows of a code matrix and return (index of first copy of each unique row, inverse map to unique rows, multiplicities) '''
+    codes = np.ascontiguousarray(codes)
+    keys = codes.view(np.dtype((np.void, codes.dtype.itemsize * codes.shape[1]))).ravel()
+    _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    # keep unique rows in order of first appearance
+    order = np.argsort(first, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.ravel()], counts[order]
@@ -0,0 +1,31 @@
+import os
+from src.predict import _split_batch_outputs, done_file
+
+def touch(path, text=''):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def test_split_batch_outputs_with_folders(tmp_path):
+    ''' Folders in the batch output (e.g. {job}_env) are copied per seed like files, and removed with the rest '''
+    out_dir, pred_dir = str(tmp_path / 'batch'), str(tmp_path / 'preds')
+    fil, job = '/clusters/MAIN_000.a3m', 'J000'
+    for name in [f'{job}.done.txt', f'{job}_coverage.png', 'log.txt', 'config.json',
+                 f'{job}_unrelaxed_rank_001_alphafold2_ptm_model_1_seed_001.pdb',
+                 f'{job}_unrelaxed_rank_002_alphafold2_ptm_model_1_seed_000.pdb',
+                 f'{job}_unrelaxed_rank_003_alphafold2_ptm_model_2_seed_000.pdb']:
+        touch(os.path.join(out_dir, name))
+    touch(os.path.join(out_dir, f'{job}_env', 'uniref.a3m'), '>q\nAAA\n')
+    os.makedirs(os.path.join(out_dir, 'cache'))  # a run-level folder, left alone
+
+    _split_batch_outputs(out_dir, pred_dir, {fil: [0, 1]}, {fil: job})
+
+    for seed, models in [(0, ['rank_001_alphafold2_ptm_model_1_seed_000', 'rank_002_alphafold2_ptm_model_2_seed_000']),
+                         (1, ['rank_001_alphafold2_ptm_model_1_seed_001'])]:
+        seed_dir = os.path.join(pred_dir, 'MAIN_000', f's{seed}')
+        assert os.path.exists(done_file(pred_dir, 'MAIN_000', seed))
+        assert sorted(f for f in os.listdir(seed_dir) if f.endswith('.pdb')) == [f'MAIN_000_0_unrelaxed_{m}.pdb' for m in models]
+        with open(os.path.join(seed_dir, 'MAIN_000_0_env', 'uniref.a3m')) as f:
+            assert f.read() == '>q\nAAA\n'
+        assert {'MAIN_000_0_coverage.png', 'log.txt', 'config.json'} <= set(os.listdir(seed_dir))
+    assert sorted(os.listdir(out_dir)) == ['cache', 'config.json', 'log.txt']
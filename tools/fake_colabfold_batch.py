@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+'''
+CPU-only stand-in for colabfold_batch, for timing the prediction stage without a GPU.
+
+Sleeps FAKE_COLABFOLD_STARTUP seconds once per process (imports, parameter
+loading, compilation) and FAKE_COLABFOLD_MODEL_TIME seconds per model, then
+writes colabfold-style outputs: ranked PDBs and score JSONs per model and
+seed, coverage/pae/plddt PNG placeholders, the input a3m and {jobname}.done.txt.
+Accepts an a3m file or a directory of them, --num-seeds, --random-seed and
+--jobname-prefix; other flags are accepted and ignored. To use it, put it on PATH as
+colabfold_batch, e.g.
+
+    mkdir -p /tmp/fakecf && ln -s $PWD/tools/fake_colabfold_batch.py /tmp/fakecf/colabfold_batch
+    PATH=/tmp/fakecf:$PATH FAKE_COLABFOLD_STARTUP=20 python afcluster.py --input input/test.fasta
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+
+def query_sequence(a3m):
+    with open(a3m) as fh:
+        for line in fh:
+            if line.strip() and not line.startswith('>'):
+                return ''.join(c for c in line.strip() if c.isupper() or c == '-').replace('-', '')
+    return ''
+
+def write_pdb(path, seq, rng):
+    x = y = z = 0.0
+    with open(path, 'w') as fh:
+        for i, res in enumerate(seq):
+            x, y, z = x + 3.8, y + rng.uniform(-1, 1), z + rng.uniform(-1, 1)
+            fh.write(f"ATOM  {i + 1:5d}  CA  {res:>3s} A{i + 1:4d}    {x:8.3f}{y:8.3f}{z:8.3f}  1.00{rng.uniform(50, 95):6.2f}           C\n")
+        fh.write("END\n")
+
+def predict(jobname, a3m, out_dir, seeds, num_models, model_time):
+    seq = query_sequence(a3m)
+    models = []
+    for seed in seeds:
+        for model in range(1, num_models + 1):
+            time.sleep(model_time)
+            rng = random.Random(hash((jobname, seed, model)))
+            plddt = [round(rng.uniform(50, 95), 2) for _ in seq]
+            models.append((sum(plddt) / max(len(plddt), 1), seed, model, plddt, rng))
+    models.sort(key=lambda m: -m[0])
+    for rank, (_, seed, model, plddt, rng) in enumerate(models, 1):
+        tag = f"rank_{rank:03d}_alphafold2_ptm_model_{model}_seed_{seed:03d}"
+        write_pdb(os.path.join(out_dir, f"{jobname}_unrelaxed_{tag}.pdb"), seq, rng)
+        pae = [[round(abs(i - j) * 0.3 + rng.uniform(0, 2), 2) for j in range(len(seq))] for i in range(len(seq))]
+        with open(os.path.join(out_dir, f"{jobname}_scores_{tag}.json"), 'w') as fh:
+            json.dump({"plddt": plddt, "max_pae": 31.75, "pae": pae, "ptm": round(rng.uniform(0.3, 0.9), 2)}, fh)
+    for name in ["coverage.png", "pae.png", "plddt.png"]:
+        open(os.path.join(out_dir, f"{jobname}_{name}"), 'wb').close()
+    shutil.copy(a3m, os.path.join(out_dir, f"{jobname}.a3m"))
+    open(os.path.join(out_dir, f"{jobname}.done.txt"), 'w').close()
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("input")
+    p.add_argument("results")
+    p.add_argument("--num-seeds", type=int, default=1)
+    p.add_argument("--random-seed", type=int, default=0)
+    p.add_argument("--num-models", type=int, default=5)
+    p.add_argument("--jobname-prefix", type=str, default=None)
+    for flag in ["--num-recycle", "--num-relax", "--model-type", "--msa-mode", "--stop-at-score"]:
+        p.add_argument(flag, type=str, default=None)  # accepted and ignored
+    args, _ = p.parse_known_args()
+
+    time.sleep(float(os.environ.get("FAKE_COLABFOLD_STARTUP", 10)))
+    model_time = float(os.environ.get("FAKE_COLABFOLD_MODEL_TIME", 0.2))
+
+    if os.path.isdir(args.input):
+        inputs = sorted(os.path.join(args.input, f) for f in os.listdir(args.input) if f.endswith('.a3m'))
+    else:
+        inputs = [args.input]
+    os.makedirs(args.results, exist_ok=True)
+    seeds = list(range(args.random_seed, args.random_seed + args.num_seeds))
+    for i, a3m in enumerate(inputs):
+        jobname = f"{args.jobname_prefix}_{i}" if args.jobname_prefix else os.path.splitext(os.path.basename(a3m))[0]
+        if os.path.exists(os.path.join(args.results, f"{jobname}.done.txt")):
+            continue
+        predict(jobname, a3m, args.results, seeds, args.num_models, model_time)
+    with open(os.path.join(args.results, "log.txt"), 'a') as fh:
+        fh.write(f"fake colabfold_batch {' '.join(sys.argv[1:])}\n")
@@ -0,0 +1,171 @@
+'''
+Local stand-in for the ColabFold MSA API (ticket/msa, ticket/{id}, result/download/{id}).
+
+Tickets complete after --job-time seconds and return a tarball with per-query
+uniref/env a3m blocks separated by \x00, like the real server. Submissions can
+be made to fail with RATELIMIT or HTTP 500 at a given rate to exercise the
+client's retry behaviour.
+
+    python tools/mock_colabfold_server.py --port 8080
+    python tools/mock_colabfold_server.py --bench 40 --ticket-size 5 --max-in-flight 4
+'''
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import tarfile
+import argparse
+import tempfile
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+AA = "ACDEFGHIKLMNPQRSTVWY"
+
+def fake_hits(seq, n_hits, rng):
+    ''' Mutated copies of seq with a few lowercase insertions '''
+    lines = []
+    for h in range(n_hits):
+        s = [rng.choice(AA) if rng.random() < 0.2 else c for c in seq]
+        s = [c + rng.choice(AA).lower() if rng.random() < 0.02 else c for c in s]
+        lines.append(f">hit_{h}\n{''.join(s)}\n")
+    return lines
+
+def fake_result(queries, n_hits, seed=0):
+    ''' tar.gz bytes holding uniref.a3m, the env a3m and an unused pdb70 file '''
+    rng = random.Random(seed)
+    members = {}
+    for name in ["uniref.a3m", "bfd.mgnify30.metaeuk30.smag30.a3m"]:
+        blocks = [f">{M}\n{seq}\n" + "".join(fake_hits(seq, n_hits, rng)) for M, seq in queries]
+        members[name] = "\x00".join(blocks).encode()
+    members["pdb70.m8"] = b"".join(f"{M}\t1abc_A\t0.5\n".encode() for M, _ in queries)
+    out = io.BytesIO()
+    with tarfile.open(fileobj=out, mode="w:gz") as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return out.getvalue()
+
+class MockState:
+    def __init__(self, job_time, n_hits, ratelimit_rate, error_rate, seed=0):
+        self.job_time = job_time
+        self.n_hits = n_hits
+        self.ratelimit_rate = ratelimit_rate
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.tickets = {}
+        self.stats = {"submit": 0, "ratelimit": 0, "error": 0, "poll": 0, "download": 0}
+        self.lock = threading.Lock()
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, code, body, content_type="application/json"):
+            if isinstance(body, dict):
+                body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/ticket/msa":
+                return self._reply(404, {"status": "ERROR"})
+            form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+            with state.lock:
+                state.stats["submit"] += 1
+                roll = state.rng.random()
+                if roll < state.error_rate:
+                    state.stats["error"] += 1
+                    return self._reply(500, b"internal error", "text/plain")
+                if roll < state.error_rate + state.ratelimit_rate:
+                    state.stats["ratelimit"] += 1
+                    return self._reply(200, {"status": "RATELIMIT"})
+                lines = form.get("q", [""])[0].split("\n")
+                queries = [(int(h[1:]), s) for h, s in zip(lines[::2], lines[1::2]) if h.startswith(">")]
+                ID = uuid.uuid4().hex
+                state.tickets[ID] = (time.time(), queries)
+            return self._reply(200, {"id": ID, "status": "PENDING"})
+
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            ticket = state.tickets.get(parts[-1])
+            if ticket is None:
+                return self._reply(200, {"status": "ERROR"})
+            submitted, queries = ticket
+            elapsed = time.time() - submitted
+            if parts[:1] == ["ticket"]:
+                with state.lock:
+                    state.stats["poll"] += 1
+                if elapsed < state.job_time / 2:
+                    status = "PENDING"
+                elif elapsed < state.job_time:
+                    status = "RUNNING"
+                else:
+                    status = "COMPLETE"
+                return self._reply(200, {"id": parts[-1], "status": status})
+            if parts[:2] == ["result", "download"]:
+                with state.lock:
+                    state.stats["download"] += 1
+                return self._reply(200, fake_result(queries, state.n_hits), "application/gzip")
+            return self._reply(404, {"status": "ERROR"})
+    return Handler
+
+def serve(port=0, job_time=2.0, n_hits=20, ratelimit_rate=0.0, error_rate=0.0):
+    ''' Start the mock server on a background thread; returns (server, state) '''
+    state = MockState(job_time, n_hits, ratelimit_rate, error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+def bench(args):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from src.utils.mmseqs import run_mmseqs2
+
+    server, state = serve(0, args.job_time, args.n_hits, args.ratelimit_rate, args.error_rate)
+    host_url = f"http://127.0.0.1:{server.server_address[1]}"
+    rng = random.Random(0)
+    seqs = ["".join(rng.choice(AA) for _ in range(args.length)) for _ in range(args.bench)]
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.time()
+        a3ms = run_mmseqs2(seqs, os.path.join(tmp, "bench"), host_url=host_url,
+                           ticket_size=args.ticket_size, max_in_flight=args.max_in_flight,
+                           poll_base=args.poll_base, poll_cap=args.poll_cap)
+        elapsed = time.time() - start
+    server.shutdown()
+    assert all(a3m.split("\n")[1] == seq for seq, a3m in zip(seqs, a3ms))
+    print(json.dumps({"queries": len(seqs), "seconds": round(elapsed, 3),
+                      "queries_per_s": round(len(seqs) / elapsed, 3), **state.stats}, indent=2))
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser()
+    p.add_argument("--port", type=int, default=8080)
+    p.add_argument("--job-time", type=float, default=2.0, help="Seconds until a ticket completes")
+    p.add_argument("--n-hits", type=int, default=20, help="Fake hits per query and database")
+    p.add_argument("--ratelimit-rate", type=float, default=0.0, help="Fraction of submissions answered with RATELIMIT")
+    p.add_argument("--error-rate", type=float, default=0.0, help="Fraction of submissions answered with HTTP 500")
+    p.add_argument("--bench", type=int, default=0, help="Run the API client against a private server with this many queries")
+    p.add_argument("--length", type=int, default=100)
+    p.add_argument("--ticket-size", type=int, default=10)
+    p.add_argument("--max-in-flight", type=int, default=4)
+    p.add_argument("--poll-base", type=float, default=0.5)
+    p.add_argument("--poll-cap", type=float, default=2.0)
+    args = p.parse_args()
+
+    if args.bench:
+        bench(args)
+    else:
+        server, state = serve(args.port, args.job_time, args.n_hits, args.ratelimit_rate, args.error_rate)
+        print(f"Mock ColabFold MSA server on http://127.0.0.1:{server.server_address[1]}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()